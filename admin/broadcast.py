@@ -2,6 +2,7 @@
 🔔 Broadcast System (Final Version)
 """
 
+import asyncio
 import logging
 from telegram import Update
 from telegram.ext import (
@@ -43,16 +44,8 @@ class BroadcastSystem:
         return BROADCAST_MESSAGE
 
     async def send_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        all_users = self.user_storage.get_all_users()
-        sent_count = 0
-        for user in all_users:
-            try:
-                await self.bot.app.bot.send_message(
-                    chat_id=user["telegram_id"], text=update.message.text
-                )
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Broadcast failed for {user['telegram_id']}: {e}")
+        all_users = await asyncio.to_thread(self.user_storage.get_all_users)
+        sent_count, _ = await self.bot._broadcast(update.message.text, users=all_users)
         await update.message.reply_text(
             f"✅ تم الإرسال إلى {sent_count}/{len(all_users)} مستخدم."
         )
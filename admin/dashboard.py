@@ -29,9 +29,10 @@ class AdminDashboard:
     def __init__(self, bot):
         self.bot = bot
         self.user_storage = bot.user_storage
+        self._admin_id = CONFIG["ADMIN_ID"]
 
     async def show_dashboard(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if not update.effective_user or update.effective_user.id != CONFIG["ADMIN_ID"]:
+        if not update.effective_user or update.effective_user.id != self._admin_id:
             return
         if not update.message:
             logger.error("show_dashboard called with no message in update.")
@@ -42,7 +43,7 @@ class AdminDashboard:
 
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Harden: Only allow admin to access dashboard callbacks
-        if not update.effective_user or update.effective_user.id != CONFIG["ADMIN_ID"]:
+        if not update.effective_user or update.effective_user.id != self._admin_id:
             user_id = getattr(update.effective_user, 'id', None)
             username = getattr(update.effective_user, 'username', None)
             logger.warning(f"[SECURITY] Non-admin user tried to access admin dashboard callback: id={user_id}, username={username}")
@@ -71,7 +72,7 @@ class AdminDashboard:
         try:
             if action.startswith("users_overview"):
                 try:
-                    overview_text = self._get_users_overview_text()
+                    overview_text = await asyncio.to_thread(self._get_users_overview_text)
                 except Exception as e:
                     logger.error(f"Error in users_overview: {e}", exc_info=True)
                     overview_text = "❌ حدث خطأ أثناء جلب نظرة المستخدمين. تأكد من سلامة البيانات أو أعد المحاولة."
@@ -87,11 +88,9 @@ class AdminDashboard:
                             page = int(action.split(":")[1])
                         except:
                             page = 1
-                    users = self.user_storage.get_all_users()
-                    if not isinstance(users, list):
-                        raise ValueError("users data is not a list")
-                    total_pages = max(1, (len(users) + 9) // 10)  # 10 users per page
-                    list_text = self._get_users_list_text(page=page)
+                    user_count = await asyncio.to_thread(self.user_storage.get_user_count)
+                    total_pages = max(1, (user_count + 9) // 10)  # 10 users per page
+                    list_text = await asyncio.to_thread(self._get_users_list_text, page=page)
                 except Exception as e:
                     logger.error(f"Error in view_users: {e}", exc_info=True)
                     list_text = "❌ حدث خطأ أثناء جلب قائمة المستخدمين. تأكد من سلامة البيانات أو أعد المحاولة."
@@ -109,14 +108,7 @@ class AdminDashboard:
             elif action.startswith("user_search_result:"):
                 # Show user details
                 user_id = action.split(":", 1)[1]
-                user = next(
-                    (
-                        u
-                        for u in self.user_storage.get_all_users()
-                        if str(u.get("telegram_id")) == user_id
-                    ),
-                    None,
-                )
+                user = await asyncio.to_thread(self.user_storage.get_user_by_telegram_id, int(user_id))
                 if user:
                     text = f"""👤 **تفاصيل المستخدم:**
 - الاسم: {user.get('username', '-')}
@@ -131,7 +123,7 @@ class AdminDashboard:
                 )
             elif action == "analysis":
                 await query.edit_message_text(
-                    text=self._get_analysis_text(),
+                    text=await asyncio.to_thread(self._get_analysis_text),
                     reply_markup=get_enhanced_admin_dashboard_keyboard(),
                 )
             elif action == "close_dashboard":
@@ -151,7 +143,7 @@ class AdminDashboard:
                 )
             elif action == "system_report":
                 await query.edit_message_text(
-                    text=self._get_system_report_text(),
+                    text=await asyncio.to_thread(self._get_system_report_text),
                     reply_markup=get_enhanced_admin_dashboard_keyboard(),
                 )
             elif action == "delete_user":
@@ -194,7 +186,7 @@ class AdminDashboard:
                 )
             elif action == "users_stats":
                 await query.edit_message_text(
-                    text=self._get_users_stats_text(),
+                    text=await asyncio.to_thread(self._get_users_stats_text),
                     reply_markup=get_user_management_keyboard(),
                 )
             elif action == "current_page":
@@ -207,11 +199,10 @@ class AdminDashboard:
                 quote = await self.bot.grade_analytics.get_daily_quote()
                 if quote:
                     # For admin broadcast, always translate (admin preference)
-                    message = await self.bot.grade_analytics.format_quote_dual_language(quote, do_translate=True)
+                    message = await self.bot.grade_analytics.format_quote_dual_language(quote, do_translate=True, html=True)
                 else:
                     message = "💬 رسالة اليوم:\n\nلم تتوفر رسالة اليوم حالياً."
-                sent = await self.bot.send_quote_to_all_users(message, parse_mode=ParseMode.MARKDOWN)
-                failed = 0  # We'll track failures differently
+                sent, failed = await self.bot.send_quote_to_all_users(message, parse_mode=ParseMode.HTML)
                 
                 # Create detailed feedback message
                 if failed == 0:
@@ -260,7 +251,7 @@ class AdminDashboard:
             elif action == "test_grade_notification_with_change":
                 # Simulate a grade update with a change and send notification to admin
                 fake_user = {
-                    "telegram_id": CONFIG["ADMIN_ID"],
+                    "telegram_id": self._admin_id,
                     "username": "fakeuser",
                     "username_unique": "fakeuser_unique",
                     "session_token": "fake_token"
@@ -280,12 +271,12 @@ class AdminDashboard:
                 changed_courses = self.bot._compare_grades(old_grades, new_grades, "meaningful")
                 if changed_courses:
                     # Format and send notification to admin
-                    message = await analytics.format_current_grades_with_quote(CONFIG["ADMIN_ID"], new_grades, manual=False)
+                    message = await analytics.format_current_grades_with_quote(self._admin_id, new_grades, manual=False)
                     await query.edit_message_text(
                         text="🧪 تم إرسال إشعار الدرجات (مع تغيير) إلى المدير.",
                         reply_markup=get_enhanced_admin_dashboard_keyboard()
                     )
-                    await self.bot.app.bot.send_message(chat_id=CONFIG["ADMIN_ID"], text=message)
+                    await self.bot.app.bot.send_message(chat_id=self._admin_id, text=message, parse_mode=ParseMode.HTML)
                 else:
                     await query.edit_message_text(
                         text="❌ لم يتم اكتشاف أي تغيير في الدرجات التجريبية.",
@@ -294,7 +285,7 @@ class AdminDashboard:
             elif action == "test_grade_notification_no_change":
                 # Simulate a grade update with no change (should not send notification)
                 fake_user = {
-                    "telegram_id": CONFIG["ADMIN_ID"],
+                    "telegram_id": self._admin_id,
                     "username": "fakeuser",
                     "username_unique": "fakeuser_unique",
                     "session_token": "fake_token"
@@ -329,7 +320,7 @@ class AdminDashboard:
                     await asyncio.sleep(60)
                     quote = await self.bot.grade_analytics.get_daily_quote()
                     quote_text = await self.bot.grade_analytics.format_quote_dual_language(quote, do_translate=True)
-                    await self.bot.app.bot.send_message(chat_id=CONFIG["ADMIN_ID"], text=f"🧪 إشعار اقتباس مجدول (تجريبي):\n\n{quote_text}")
+                    await self.bot.app.bot.send_message(chat_id=self._admin_id, text=f"🧪 إشعار اقتباس مجدول (تجريبي):\n\n{quote_text}")
                 asyncio.create_task(send_test_quote())
             else:
                 await query.edit_message_text(
@@ -388,12 +379,12 @@ class AdminDashboard:
             start = (page - 1) * per_page
             end = start + per_page
             users_page = users[start:end]
-            text = f"👥 **قائمة المستخدمين** (صفحة {page}):\n\n"
+            lines = [f"👥 **قائمة المستخدمين** (صفحة {page}):\n\n"]
             for i, user in enumerate(users_page, start + 1):
                 status = "🟢" if user.get("is_active", True) else "🔴"
-                text += f"{i}. {status} {user.get('username', '-')} (ID: {user.get('telegram_id', '-')})\n"
-            text += f"\n📊 إجمالي المستخدمين: {total}"
-            return text
+                lines.append(f"{i}. {status} {user.get('username', '-')} (ID: {user.get('telegram_id', '-')})\n")
+            lines.append(f"\n📊 إجمالي المستخدمين: {total}")
+            return "".join(lines)
         except Exception as e:
             logger.error(f"Error in _get_users_list_text: {e}", exc_info=True)
             return "❌ حدث خطأ أثناء جلب قائمة المستخدمين. تأكد من سلامة البيانات أو أعد المحاولة."
@@ -472,7 +463,7 @@ class AdminDashboard:
         if not context.user_data.get("awaiting_user_search"):
             return False
         query = update.message.text.strip()
-        users = self.user_storage.get_all_users()
+        users = await asyncio.to_thread(self.user_storage.get_all_users)
         results = [
             u
             for u in users
@@ -513,17 +504,10 @@ class AdminDashboard:
         user_id = update.message.text.strip()
         try:
             user_id = int(user_id)
-            user = next(
-                (
-                    u
-                    for u in self.user_storage.get_all_users()
-                    if u.get("telegram_id") == user_id
-                ),
-                None,
-            )
+            user = await asyncio.to_thread(self.user_storage.get_user_by_telegram_id, user_id)
             if user:
-                # Delete user (this will cascade to grades)
-                self.user_storage.delete_user(user_id)
+                # Delete user (this will cascade to grades); storage deletes by username
+                await asyncio.to_thread(self.user_storage.delete_user, user["username"])
                 await update.message.reply_text(
                     f"✅ تم حذف المستخدم {user.get('username', '')} بنجاح.",
                     reply_markup=get_enhanced_admin_dashboard_keyboard(),
@@ -569,72 +553,15 @@ class AdminDashboard:
         return False
 
     async def broadcast_to_all_users(self, message):
-        users = self.bot.user_storage.get_all_users()
-        sent = 0
-        failed = 0
-        blocked_users = 0
-        invalid_users = 0
-        other_errors = 0
-        
-        for user in users:
-            try:
-                await self.bot.app.bot.send_message(
-                    chat_id=user["telegram_id"], text=message
-                )
-                sent += 1
-            except Exception as e:
-                failed += 1
-                error_msg = str(e).lower()
-                if "blocked" in error_msg or "forbidden" in error_msg:
-                    blocked_users += 1
-                    logger.warning(f"User {user['telegram_id']} ({user.get('username', 'Unknown')}) blocked the bot")
-                elif "chat not found" in error_msg or "user not found" in error_msg:
-                    invalid_users += 1
-                    logger.warning(f"Invalid user ID {user['telegram_id']} ({user.get('username', 'Unknown')})")
-                else:
-                    other_errors += 1
-                    logger.error(f"Broadcast failed for {user['telegram_id']} ({user.get('username', 'Unknown')}): {e}")
-        
-        # Log detailed summary
-        logger.info(f"Broadcast summary: sent={sent}, failed={failed}, total={len(users)}")
-        if failed > 0:
-            logger.info(f"Failure breakdown: blocked={blocked_users}, invalid={invalid_users}, other={other_errors}")
-        
-        return sent, failed
+        # Sent through the bot's paced concurrent broadcast, which logs the failure breakdown
+        users = await asyncio.to_thread(self.bot.user_storage.get_all_users)
+        sent, failures = await self.bot._broadcast(message, users=users)
+        return sent, sum(failures.values())
 
     async def send_quote_to_all_users(self, message):
-        users = self.bot.user_storage.get_all_users()
-        sent = 0
-        failed = 0
-        blocked_users = 0
-        invalid_users = 0
-        other_errors = 0
-        
-        for user in users:
-            try:
-                await self.bot.app.bot.send_message(
-                    chat_id=user["telegram_id"], text=message
-                )
-                sent += 1
-            except Exception as e:
-                failed += 1
-                error_msg = str(e).lower()
-                if "blocked" in error_msg or "forbidden" in error_msg:
-                    blocked_users += 1
-                    logger.warning(f"User {user['telegram_id']} ({user.get('username', 'Unknown')}) blocked the bot")
-                elif "chat not found" in error_msg or "user not found" in error_msg:
-                    invalid_users += 1
-                    logger.warning(f"Invalid user ID {user['telegram_id']} ({user.get('username', 'Unknown')})")
-                else:
-                    other_errors += 1
-                    logger.error(f"Quote broadcast failed for {user['telegram_id']} ({user.get('username', 'Unknown')}): {e}")
-        
-        # Log detailed summary
-        logger.info(f"Quote broadcast summary: sent={sent}, failed={failed}, total={len(users)}")
-        if failed > 0:
-            logger.info(f"Failure breakdown: blocked={blocked_users}, invalid={invalid_users}, other={other_errors}")
-        
-        return sent, failed
+        users = await asyncio.to_thread(self.bot.user_storage.get_all_users)
+        sent, failures = await self.bot._broadcast(message, users=users)
+        return sent, sum(failures.values())
 
     async def handle_force_grade_check_message(self, update, context):
         """
@@ -643,7 +570,7 @@ class AdminDashboard:
         if not context.user_data.get("awaiting_force_grade_check"):
             return False
         query = update.message.text.strip()
-        users = self.user_storage.get_all_users()
+        users = await asyncio.to_thread(self.user_storage.get_all_users)
         user = next(
             (u for u in users if query == str(u.get("telegram_id")) or query.lower() == (u.get("username", "").lower() or "")),
             None,
@@ -676,8 +603,7 @@ class AdminDashboard:
         """
         Force refresh grades for a user and print summary (no HTML).
         """
-        users = self.user_storage.get_all_users()
-        user = next((u for u in users if str(u.get("telegram_id")) == str(telegram_id)), None)
+        user = await asyncio.to_thread(self.user_storage.get_user_by_telegram_id, int(telegram_id))
         if not user:
             await query.edit_message_text(
                 "❌ المستخدم غير موجود.",
@@ -698,10 +624,12 @@ class AdminDashboard:
             api = self.bot.university_api
             grades = await api.fetch_and_parse_grades(token, int(telegram_id))
             if grades:
-                msg = f"✅ الدرجات الحالية للمستخدم {username} ({telegram_id}):\n"
-                for g in grades:
-                    msg += f"- {g.get('name', '-')}: {g.get('total', '-')}, الأعمال: {g.get('coursework', '-')}, النظري: {g.get('final_exam', '-')}, الكود: {g.get('code', '-')},\n"
-                await query.edit_message_text(msg[:4096])
+                lines = [f"✅ الدرجات الحالية للمستخدم {username} ({telegram_id}):\n"]
+                lines.extend(
+                    f"- {g.get('name', '-')}: {g.get('total', '-')}, الأعمال: {g.get('coursework', '-')}, النظري: {g.get('final_exam', '-')}, الكود: {g.get('code', '-')},\n"
+                    for g in grades
+                )
+                await query.edit_message_text("".join(lines)[:4096])
             else:
                 await query.edit_message_text("❌ لم يتم العثور على درجات.")
         except Exception as e:
@@ -711,8 +639,7 @@ class AdminDashboard:
         """
         Fetch and show raw HTML for a user's grades (for troubleshooting).
         """
-        users = self.user_storage.get_all_users()
-        user = next((u for u in users if str(u.get("telegram_id")) == str(telegram_id)), None)
+        user = await asyncio.to_thread(self.user_storage.get_user_by_telegram_id, int(telegram_id))
         if not user:
             await query.edit_message_text(
                 "❌ المستخدم غير موجود.",
@@ -2,19 +2,30 @@
 🎓 Telegram Bot Core - Main Bot Implementation
 """
 import asyncio
+from collections import Counter
+import hashlib
+import hmac
+import logging
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
 
 from sqlalchemy import update
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters,
     ContextTypes, ConversationHandler
 )
-from typing import Dict, List
+from typing import Dict, Final, List, Optional
 import re
 import os
-import json
+import random
+import secrets
+import weakref
+from zoneinfo import ZoneInfo
+
+import orjson
 
 from config import CONFIG
 from storage.models import DatabaseManager
@@ -32,9 +43,10 @@ from utils.keyboards import (
 from utils.messages import get_welcome_message, get_help_message, get_simple_welcome_message, get_security_welcome_message, get_credentials_security_info_message
 from security.enhancements import security_manager, is_valid_length
 from security.headers import security_headers, security_policy
-from utils.analytics import GradeAnalytics
+from utils.analytics import GradeAnalytics, gpa_points_table
+from utils.crypto import encrypt_password, decrypt_password
 from utils.settings import UserSettings
-from university.api_client_v2 import UniversityAPIV2
+from university.api_client_v2 import UniversityAPIV2, InvalidTokenError
 from utils.logger import get_bot_logger
 
 # Get bot logger
@@ -47,6 +59,249 @@ ASK_SETTINGS_MAIN, ASK_SESSION_MANAGEMENT = 20, 21
 # Add new state for older terms selection
 ASK_OLDER_TERM_NUMBER = 30
 
+# Identity settings that never change at runtime, read from CONFIG once
+ADMIN_ID: Final[int] = int(CONFIG["ADMIN_ID"])
+ADMIN_USERNAME: Final[str] = CONFIG.get("ADMIN_USERNAME", "@admin")
+TELEGRAM_TOKEN: Final[str] = CONFIG["TELEGRAM_TOKEN"]
+
+# Timezone used for the daily quote schedule (UTC+3)
+_TZ = ZoneInfo("Asia/Riyadh")
+
+# Telegram allows roughly 30 messages per second across all chats
+BROADCAST_MESSAGES_PER_SECOND = 30
+
+# Users loaded per page when streaming the daily quote broadcast
+QUOTE_BROADCAST_PAGE_SIZE = 100
+
+# Number of users whose refreshed grades are written per bulk store
+SILENT_UPDATE_BATCH_SIZE = 50
+
+# Fraction of GRADE_CHECK_INTERVAL by which each wait between sweeps is randomly lengthened or shortened
+GRADE_CHECK_JITTER = 0.1
+
+# Users per stored-grades prefetch query in the notifying grade sweep
+GRADE_CHECK_PAGE_SIZE = 200
+
+# Upper bound on one user's grade check (grade fetch, possible re-login, notification)
+GRADE_CHECK_USER_TIMEOUT_SECONDS = 120
+
+# Grade fields reported in change notifications, with their Arabic labels
+GRADE_CHANGE_FIELDS = (
+    ("coursework", "الأعمال"),
+    ("final_exam", "النظري"),
+    ("total", "النهائي"),
+)
+
+# Periodic background jobs allowed to run at the same time
+BACKGROUND_JOB_CONCURRENCY = 1
+
+# Hash of the last BOT_NAME/BOT_DESCRIPTION pushed to Telegram
+BOT_INFO_HASH_FILE = os.path.join(CONFIG["DATA_DIR"], "bot_info.sha1")
+
+# Registration input checks: university code format and characters rejected in passwords
+_UNI_CODE_RE = re.compile(r"[A-Za-z]{3,}[0-9]{4,}")
+_BAD_PASSWORD_CHARS_RE = re.compile(r"[<>\"'&;|`$(){}]")
+
+# Session-type buttons shown during registration
+BTN_TEMP = "🔒 جلسة مؤقتة (لا يتم تخزين كلمة المرور)"
+BTN_PERM = "🔑 جلسة دائمة (تخزين كلمة المرور مشفر)"
+
+# Static reply keyboards (PTB markup objects are immutable and safe to share)
+_CANCEL_KEYBOARD = ReplyKeyboardMarkup([["❌ إلغاء"]], resize_keyboard=True, one_time_keyboard=True)
+_SESSION_TYPE_KEYBOARD = ReplyKeyboardMarkup([[BTN_TEMP, BTN_PERM]], resize_keyboard=True, one_time_keyboard=True)
+_TEMP_SESSION_KEYBOARD = ReplyKeyboardMarkup([[BTN_TEMP]], resize_keyboard=True, one_time_keyboard=True)
+
+# Exact-text button filters for the conversation entry points (a set lookup instead of a regex match)
+LOGIN_TEXTS = frozenset({"🚀 تسجيل الدخول للجامعة", "🚀 تسجيل الدخول"})
+_LOGIN_FILTER = filters.Text(LOGIN_TEXTS)
+_CANCEL_FILTER = filters.Text(frozenset({"❌ إلغاء"}))
+_GPA_CALC_FILTER = filters.Text(frozenset({"🧮 حساب المعدل المخصص"}))
+_OLDER_TERMS_FILTER = filters.Text(frozenset({"📅 جميع الفصول"}))
+_SESSION_MANAGEMENT_FILTER = filters.Text(frozenset({"🔑 إدارة الجلسة/كلمة المرور"}))
+_BACK_FILTER = filters.Text(frozenset({"🔙 العودة"}))
+
+# Admin prompts awaiting a text reply, checked in order: user_data flag -> AdminDashboard handler
+_ADMIN_AWAITING_DISPATCH = (
+    ("awaiting_user_search", "handle_user_search_message"),
+    ("awaiting_user_delete", "handle_user_delete_message"),
+    ("awaiting_broadcast", "handle_dashboard_message"),
+)
+_ADMIN_AWAITING_KEYS = frozenset(flag for flag, _ in _ADMIN_AWAITING_DISPATCH)
+
+# Session-type suffixes appended to the registration welcome message
+WELCOME_SUFFIX_PERMANENT = "\n\n🔑 **جلسة دائمة**\nكلمة المرور مخزنة بشكل مشفر. سيتم تسجيل الدخول تلقائياً عند انتهاء الجلسة."
+WELCOME_SUFFIX_TEMPORARY = "\n\n🔐 **جلسة مؤقتة**\nكلمة المرور لم تُخزن. ستحتاج لتسجيل الدخول مرة أخرى عند انتهاء الجلسة."
+
+
+# Static command replies, built once at import
+_HELP_TEXT_BODY = (
+    "🎓 دليل استخدام البوت\n\n"
+    "كيفية الاستخدام:\n"
+    "1. اضغط '🚀 تسجيل الدخول' وأدخل بياناتك الجامعية\n"
+    "2. استخدم الأزرار لفحص الدرجات والإعدادات\n"
+    "3. استعمل الأزرار للمساعدة أو الدعم الفني\n\n"
+    "الأوامر الأساسية:\n"
+    "/start - بدء الاستخدام\n"
+    "/help - المساعدة\n"
+    "/grades - التحقق من درجات الفصل الحالي\n"
+    "/old_grades - التحقق من درجات الفصل السابق\n"
+    "/profile - معلوماتي\n"
+    "/settings - الإعدادات\n"
+    "/support - الدعم الفني\n\n"
+    "أوامر الأمان:\n"
+    "/security_info - معلومات الأمان\n"
+    "/security_audit - تقرير التدقيق الأمني\n"
+    "/security_headers - معلومات معايير الأمان (للمطور فقط)\n"
+    "/privacy_policy - سياسة الخصوصية\n"
+)
+_HELP_TEXT_FOOTER = f"\n👨‍💻 المطور: {ADMIN_USERNAME}"
+HELP_TEXT_USER = _HELP_TEXT_BODY + _HELP_TEXT_FOOTER
+HELP_TEXT_ADMIN = _HELP_TEXT_BODY + "\nأوامر المدير:\n/security_stats - إحصائيات الأمان\n/admin - لوحة التحكم\n" + _HELP_TEXT_FOOTER
+SECURITY_AUDIT_MESSAGE = (
+    "📋 تقرير التدقيق الأمني:\n\n"
+    "• جميع العمليات في البوت تخضع لمراجعة دورية لضمان الأمان.\n"
+    "• لا يتم تخزين كلمات المرور أو مشاركتها مع أي جهة.\n"
+    "• نستخدم أحدث معايير الأمان لحماية بياناتك.\n\n"
+    "إذا كان لديك أي سؤال عن الأمان، تواصل مع الدعم الفني."
+)
+PRIVACY_POLICY_MESSAGE = (
+    "🔒 سياسة الخصوصية:\n\n"
+    "• بياناتك الجامعية تُستخدم فقط لجلب الدرجات ولا يتم تخزين كلمة المرور نهائياً.\n"
+    "• جميع المعلومات مشفرة وآمنة ولا يتم مشاركتها مع أي جهة خارجية.\n"
+    "• يمكنك حذف بياناتك في أي وقت من خلال الدعم الفني.\n"
+    "• هدفنا هو حماية خصوصيتك وتقديم أفضل تجربة ممكنة.\n\n"
+    "لأي استفسار عن الخصوصية، تواصل مع الدعم الفني."
+)
+SECURITY_HEADERS_MESSAGE = (
+    "🛡️ معلومات الأمان:\n\n"
+    "• البوت يستخدم تقنيات حماية متقدمة لضمان سرية بياناتك.\n"
+    "• جميع الاتصالات مشفرة وآمنة.\n"
+    "• لا داعي للقلق بشأن الخصوصية أو الأمان.\n\n"
+    "لأي استفسار، تواصل مع الدعم الفني."
+)
+SETTINGS_MESSAGE = (
+    "⚙️ إعدادات الحساب\n\n"
+    "يمكنك التحكم في بياناتك والوصول إلى خيارات الخصوصية.\n"
+    "كل شيء في هذا البوت شفاف ويمكنك دائماً معرفة كيف يتم التعامل مع بياناتك.\n\n"
+    "- يمكنك زيارة الكود البرمجي على GitHub."
+)
+SUPPORT_MESSAGE = f"📞 للدعم الفني: {ADMIN_USERNAME}\nاضغط الزر أدناه للتواصل مباشرة."
+UNKNOWN_BUTTON_MESSAGE = "هذه الميزة قيد التطوير. سيتم توفيرها قريباً.\n\n📞 للمساعدة: اضغط '📞 الدعم الفني' أو الزر أدناه."
+UNEXPECTED_ERROR_MESSAGE = (
+    "❌ حدث خطأ غير متوقع\n\n**الحلول:**\n• جرب مرة أخرى بعد قليل\n"
+    f"• إذا استمرت المشكلة، لا تتردد في التواصل مع المطور {ADMIN_USERNAME}\n"
+    "• تأكد من اتصالك بالإنترنت\n\n📞 للمساعدة: اضغط '📞 الدعم الفني' أو الزر أدناه."
+)
+
+# Minimum spacing between [UX ERROR] alerts to the admin, so an outage doesn't flood the admin chat
+ADMIN_ERROR_ALERT_INTERVAL_SECONDS = 60
+
+
+@dataclass(slots=True)
+class RegistrationState:
+    """Per-conversation state of the registration flow, kept under one user_data key"""
+    username: str = ""
+    password: Optional[str] = None
+    session_type: str = "temporary"
+    password_stored: bool = False
+    password_consent_given: bool = False
+    password_confirm_attempts: int = 0
+    user_data: Optional[dict] = None
+    token: Optional[str] = None
+    # Whether a user row existed when the flow started (the row survives a relogin)
+    was_registered: bool = False
+
+
+def _registration_state(context) -> RegistrationState:
+    """Return the registration state stored in the conversation's user_data"""
+    return context.user_data.setdefault('_reg', RegistrationState())
+
+
+@dataclass(slots=True)
+class GpaCourse:
+    """One course entered in the custom GPA calculator"""
+    percentage: int
+    ects: float = 0.0
+
+
+@dataclass(slots=True)
+class GpaState:
+    """Per-conversation state of the custom GPA calculator"""
+    courses: List[GpaCourse] = field(default_factory=list)
+    current: int = 0
+    count: int = 0
+
+
+def _gpa_state(context) -> GpaState:
+    """Return the GPA calculator state stored in the conversation's user_data"""
+    return context.user_data.setdefault('gpa_calc', GpaState())
+
+
+def _parse_percentage(text):
+    """Return the integer part of the first number in text (e.g. "85.9%" -> 85)"""
+    if text.isdecimal():
+        return int(text)
+    start = 0
+    length = len(text)
+    while start < length and not text[start].isdecimal():
+        start += 1
+    if start == length:
+        raise ValueError("No digits found")
+    end = start + 1
+    while end < length and text[end].isdecimal():
+        end += 1
+    return int(text[start:end])
+
+
+def _parse_quote_schedule(time_str):
+    """Parse a QUOTE_SCHEDULE value ("HH:MM") into (hour, minute), defaulting to 14:00"""
+    try:
+        hour, minute = map(int, time_str.strip().split(":"))
+        if 0 <= hour < 24 and 0 <= minute < 60:
+            return hour, minute
+    except Exception:
+        pass
+    return 14, 0  # default time
+
+
+_UTC3 = timezone(timedelta(hours=3))
+# (minute since epoch, formatted stamp) of the last notification timestamp
+_update_stamp = (None, "")
+
+
+def _update_timestamp():
+    """Current UTC+3 time as "YYYY-MM-DD HH:MM"; formatted once per minute, as a sweep sends many notifications"""
+    global _update_stamp
+    minute = int(datetime.now(timezone.utc).timestamp()) // 60
+    if _update_stamp[0] != minute:
+        _update_stamp = (minute, datetime.fromtimestamp(minute * 60, _UTC3).strftime('%Y-%m-%d %H:%M'))
+    return _update_stamp[1]
+
+
+def _split_message(text, limit=CONFIG["MAX_MESSAGE_LENGTH"]):
+    """Pack whole lines into chunks of at most `limit` characters (a single overlong line is hard-split)"""
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    buf = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if buf:
+                chunks.append(buf)
+                buf = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{buf}\n{line}" if buf else line
+        if len(candidate) > limit:
+            chunks.append(buf)
+            buf = line
+        else:
+            buf = candidate
+    if buf:
+        chunks.append(buf)
+    return chunks
+
+
 class TelegramBot:
     """Main Telegram Bot Class"""
     
@@ -61,35 +316,127 @@ class TelegramBot:
         self.admin_dashboard = AdminDashboard(self)
         self.broadcast_system = BroadcastSystem(self)
         self.grade_check_task = None
+        self.daily_quote_task = None
         self.running = False
-        self._user_locks = {}  # username_unique: asyncio.Lock
+        # Checked on nearly every update
+        self._admin_id = ADMIN_ID
+        # Webhook settings come from the environment and are fixed for the process lifetime
+        self._port = int(os.environ.get("PORT", 8000))
+        self._webhook_url = self._resolve_webhook_url()
+        # Reply keyboards are static; build each once and share it across replies
+        self._kb_main = get_main_keyboard()
+        self._kb_unregistered = get_unregistered_keyboard()
+        self._kb_error = get_error_recovery_keyboard()
+        self._kb_admin = get_admin_keyboard()
+        self._kb_cancel = get_cancel_keyboard()
+        self._keyboards = {
+            "main": self._kb_main,
+            "admin": self._kb_admin,
+            "cancel": self._kb_cancel,
+            "unregistered": self._kb_unregistered,
+            "error_recovery": self._kb_error,
+        }
+        # Heavy periodic jobs (grade sweep, daily broadcast) take turns instead of
+        # overlapping and competing for the DB pool and Telegram's send budget
+        self._background_jobs = asyncio.Semaphore(BACKGROUND_JOB_CONCURRENCY)
+        # Per-user university API work across all sweeps, including admin-triggered ones that
+        # bypass _background_jobs, stays within MAX_CONCURRENT_REQUESTS
+        self._grade_check_slots = asyncio.Semaphore(CONFIG.get('MAX_CONCURRENT_REQUESTS', 5))
+        # Grade notifications are sent from concurrent checks; _pace_send spaces them out
+        self._send_pace_lock = asyncio.Lock()
+        self._next_send_at = 0.0
+        # Monotonic time of the last [UX ERROR] alert sent to the admin
+        self._last_admin_error_alert = None
+        # storage username -> asyncio.Lock; an entry lives only while some task holds a reference to its lock
+        self._user_locks = weakref.WeakValueDictionary()
+        # Settings/privacy inline-button callbacks: callback_data -> handler
+        self._settings_callbacks = {
+            "delete_user_data": self._cb_delete_user_data,
+            "confirm_delete_data": self._cb_confirm_delete_data,
+            "cancel_delete_data": self._cb_cancel_delete_data,
+            "toggle_show_profile": self._cb_toggle_show_profile,
+            "toggle_share_stats": self._cb_toggle_share_stats,
+            "data_retention": self._cb_data_retention,
+            "back_to_settings": self._cb_back_to_settings,
+            "back_to_main": self._cb_back_to_main,
+            "cancel_action": self._cb_cancel_action,
+        }
+        # Main-keyboard button text -> handler (current and legacy labels)
+        self._button_actions = {
+            # Grade actions
+            "📊 درجات الفصل الحالي": self._grades_command,
+            "📚 درجات الفصل السابق": self._old_grades_command,
+            # User actions
+            "👤 معلوماتي الشخصية": self._profile_command,
+            "⚙️ الإعدادات والتخصيص": self._settings_command,
+            # Support/help
+            "📞 الدعم الفني": self._support_command,
+            "❓ المساعدة والدليل": self._help_command,
+            # Registration
+            "🚀 تسجيل الدخول للجامعة": self._register_start,
+            # Admin
+            "🎛️ لوحة التحكم الإدارية": self._admin_command,
+            "🔙 العودة للوحة الرئيسية": self._return_to_main,
+            # Legacy button support
+            "📊 التحقق من درجات الفصل الحالي": self._grades_command,
+            "📚 التحقق من درجات الفصل السابق": self._old_grades_command,
+            "👤 معلوماتي": self._profile_command,
+            "⚙️ الإعدادات": self._settings_command,
+            "📞 الدعم": self._support_command,
+            "❓ المساعدة": self._help_command,
+            "🚀 تسجيل الدخول": self._register_start,
+            "🎛️ لوحة التحكم": self._admin_command,
+            "🔙 العودة": self._return_to_main,
+            # Info about bot
+            "❓ كيف يعمل البوت؟": self._how_it_works_command,
+            # Logout
+            "🚪 تسجيل الخروج": self._logout_command,
+            # Refresh keyboard
+            "🔄 تحديث الأزرار": self._refresh_keyboard,
+            "🧮 حساب المعدل المخصص": self._gpa_calc_start,
+            "📅 جميع الفصول": self._older_terms_command,
+            "📥 تحميل معلوماتي": self._download_my_info_command,
+            # Session-type buttons pressed outside registration
+            BTN_TEMP: self._session_button_outside_registration,
+            BTN_PERM: self._session_button_outside_registration,
+        }
 
     def _initialize_storage(self):
         pg_initialized = False
         # Initialize new clean storage systems
         try:
             logger.info("🗄️ Initializing new clean storage systems...")
-            self.user_storage = UserStorageV2(CONFIG["MYSQL_URL"])
-            self.grade_storage = GradeStorageV2(CONFIG["MYSQL_URL"])
+            # Both storages share one engine and connection pool
+            db_manager = DatabaseManager(
+                CONFIG["MYSQL_URL"],
+                pool_size=CONFIG["DB_POOL_SIZE"],
+                max_overflow=CONFIG["DB_MAX_OVERFLOW"],
+            )
+            self.grade_storage = GradeStorageV2(CONFIG["MYSQL_URL"], db_manager=db_manager)
+            self.user_storage = UserStorageV2(CONFIG["MYSQL_URL"], grade_storage=self.grade_storage, db_manager=db_manager)
             logger.info("✅ New storage systems initialized successfully.")
         except Exception as e:
             logger.critical(f"❌ FATAL: Storage initialization failed. Bot cannot run: {e}", exc_info=True)
             raise RuntimeError("Failed to initialize storage systems.")
 
-    def _get_user_lock(self, username_unique):
-        if username_unique not in self._user_locks:
-            self._user_locks[username_unique] = asyncio.Lock()
-        return self._user_locks[username_unique]
+    async def _get_user(self, telegram_id):
+        """Look a user up by Telegram ID; cache hits return inline, misses query MySQL off the event loop"""
+        hit, user = self.user_storage.peek_cached_user(telegram_id)
+        if hit:
+            return user
+        return await asyncio.to_thread(self.user_storage.get_user_by_telegram_id, telegram_id)
 
-    async def start(self):
-        self.running = True
-        self.app = Application.builder().token(CONFIG["TELEGRAM_TOKEN"]).build()
-        await self._update_bot_info()
-        self._add_handlers()
-        await self.app.initialize()
-        await self.app.start()
-        port = int(os.environ.get("PORT", 8000))
-        
+    async def _is_registered(self, telegram_id):
+        return await self._get_user(telegram_id) is not None
+
+    def _get_user_lock(self, storage_username):
+        lock = self._user_locks.get(storage_username)
+        if lock is None:
+            lock = self._user_locks[storage_username] = asyncio.Lock()
+        return lock
+
+    def _resolve_webhook_url(self):
+        """Work out the public webhook URL from the deployment environment."""
         # Try to get Railway URL from environment
         railway_app_name = os.getenv("RAILWAY_APP_NAME")
         
@@ -98,7 +445,7 @@ class TelegramBot:
         if webhook_url_env and webhook_url_env.startswith("https://"):
             # Use the provided webhook URL
             webhook_url = webhook_url_env
-            railway_url = webhook_url_env.replace(f"/{CONFIG['TELEGRAM_TOKEN']}", "")
+            railway_url = webhook_url_env.replace(f"/{TELEGRAM_TOKEN}", "")
         else:
             # Build webhook URL from Railway domain
             railway_url = (
@@ -111,13 +458,32 @@ class TelegramBot:
             )
             
             # Final webhook URL
-            webhook_url = f"https://{railway_url}/{CONFIG['TELEGRAM_TOKEN']}"
-        
-        logger.info(f"🌐 Webhook URL: {webhook_url}")
+            webhook_url = f"https://{railway_url}/{TELEGRAM_TOKEN}"
         logger.info(f"🔧 Railway URL source: {railway_url}")
+        return webhook_url
+
+    async def start(self):
+        self.running = True
+        # Updates stay sequential: the ConversationHandlers rely on each chat's
+        # updates being processed one at a time
+        self.app = Application.builder().token(TELEGRAM_TOKEN).build()
+        await self._update_bot_info()
+        self._add_handlers()
+        await self.app.initialize()
+        await self.app.start()
+        logger.info(f"🌐 Webhook URL: {self._webhook_url}")
         
-        await self.app.updater.start_webhook(listen="0.0.0.0", port=port, url_path=CONFIG["TELEGRAM_TOKEN"], webhook_url=webhook_url)
-        logger.info(f"✅ Bot started on webhook: {webhook_url}")
+        # PTB's webhook server only validates the update and enqueues it before answering 200,
+        # so Telegram is acked before any handler runs; the secret rejects forged POSTs.
+        # set_webhook runs on every start, so a per-process secret works when none is configured.
+        await self.app.updater.start_webhook(
+            listen="0.0.0.0",
+            port=self._port,
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=self._webhook_url,
+            secret_token=CONFIG["WEBHOOK_SECRET"] or secrets.token_urlsafe(32),
+        )
+        logger.info(f"✅ Bot started on webhook: {self._webhook_url}")
 
         # Start background tasks only if not running under cron
         if os.getenv("RUN_GRADE_CHECK") != "1":
@@ -125,32 +491,55 @@ class TelegramBot:
             self.daily_quote_task = asyncio.create_task(self.scheduled_daily_quote_broadcast())
 
     async def _update_bot_info(self):
+        # Name/description almost never change; skip the Telegram round-trips when the
+        # values were already applied by an earlier start
+        info_hash = hashlib.sha1(f"{CONFIG['BOT_NAME']}|{CONFIG['BOT_DESCRIPTION']}".encode()).hexdigest()
+        try:
+            with open(BOT_INFO_HASH_FILE, encoding="utf-8") as f:
+                if f.read().strip() == info_hash:
+                    return
+        except OSError:
+            pass
         try:
-            # Only update bot name/description if needed
-            current_name = await self.app.bot.get_my_name()
+            current_name, current_desc = await asyncio.gather(
+                self.app.bot.get_my_name(), self.app.bot.get_my_description()
+            )
+            applied = True
             if current_name.name != CONFIG["BOT_NAME"]:
                 try:
                     await self.app.bot.set_my_name(CONFIG["BOT_NAME"])
                 except Exception as e:
+                    applied = False
                     logger.warning(f"⚠️ Failed to set bot name: {e}")
-            current_desc = await self.app.bot.get_my_description()
             if current_desc.description != CONFIG["BOT_DESCRIPTION"]:
                 try:
                     await self.app.bot.set_my_description(CONFIG["BOT_DESCRIPTION"])
                 except Exception as e:
+                    applied = False
                     logger.warning(f"⚠️ Failed to set bot description: {e}")
         except Exception as e:
             logger.warning(f"⚠️ Failed to update bot info: {e}")
+            return
+        if applied:
+            try:
+                os.makedirs(os.path.dirname(BOT_INFO_HASH_FILE), exist_ok=True)
+                with open(BOT_INFO_HASH_FILE, "w", encoding="utf-8") as f:
+                    f.write(info_hash)
+            except OSError as e:
+                logger.warning(f"⚠️ Failed to record bot info hash: {e}")
 
     async def stop(self):
         self.running = False
-        if self.grade_check_task:
-            self.grade_check_task.cancel()
-        if hasattr(self, 'daily_quote_task') and self.daily_quote_task:
-            self.daily_quote_task.cancel()
+        tasks = [task for task in (self.grade_check_task, self.daily_quote_task) if task]
+        for task in tasks:
+            task.cancel()
+        # Wait for the loops to unwind so no job is still using the DB or the API session
+        # when the app shuts down
+        await asyncio.gather(*tasks, return_exceptions=True)
         if self.app:
             await self.app.stop()
             await self.app.shutdown()
+        await self.university_api.close()
         logger.info("🛑 Bot stopped.")
 
     def _add_handlers(self):
@@ -158,7 +547,7 @@ class TelegramBot:
         registration_handler = ConversationHandler(
             entry_points=[
                 CommandHandler("register", self._register_start),
-                MessageHandler(filters.Regex("^🚀 تسجيل الدخول للجامعة$"), self._register_start)
+                MessageHandler(_LOGIN_FILTER, self._register_start)
             ],
             states={
                 ASK_USERNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, self._register_username)],
@@ -166,14 +555,16 @@ class TelegramBot:
                 ASK_SESSION_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, self._register_session_type)],
                 ASK_PASSWORD_CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, self._register_password_confirm)],
             },
-            fallbacks=[CommandHandler("cancel", self._cancel_registration), MessageHandler(filters.Regex("^❌ إلغاء$"), self._cancel_registration)],
+            fallbacks=[CommandHandler("cancel", self._cancel_registration), MessageHandler(_CANCEL_FILTER, self._cancel_registration)],
         )
         self.app.add_handler(registration_handler)
         self.app.add_handler(self.broadcast_system.get_conversation_handler())
         self.app.add_handler(CommandHandler("start", self._start_command))
         self.app.add_handler(CommandHandler("help", self._help_command))
-        self.app.add_handler(CommandHandler("grades", self._grades_command))
-        self.app.add_handler(CommandHandler("old_grades", self._old_grades_command))
+        # Handlers that wait on the university API run as background tasks (block=False)
+        # so they don't hold up the update queue; conversation steps stay blocking
+        self.app.add_handler(CommandHandler("grades", self._grades_command, block=False))
+        self.app.add_handler(CommandHandler("old_grades", self._old_grades_command, block=False))
         self.app.add_handler(CommandHandler("profile", self._profile_command))
         self.app.add_handler(CommandHandler("settings", self._settings_command))
         self.app.add_handler(CommandHandler("support", self._support_command))
@@ -185,62 +576,55 @@ class TelegramBot:
         self.app.add_handler(CommandHandler("security_headers", self._security_headers_command))
         # Admin panel command
         self.app.add_handler(CommandHandler("admin", self._admin_command))
-        self.app.add_handler(CommandHandler("notify_grades", self._admin_notify_grades))
-        self.app.add_handler(CallbackQueryHandler(self._handle_callback))
+        self.app.add_handler(CommandHandler("notify_grades", self._admin_notify_grades, block=False))
+        self.app.add_handler(CallbackQueryHandler(self._handle_callback, block=False))
         gpa_calc_handler = ConversationHandler(
-            entry_points=[MessageHandler(filters.Regex("^🧮 حساب المعدل المخصص$"), self._gpa_calc_start)],
+            entry_points=[MessageHandler(_GPA_CALC_FILTER, self._gpa_calc_start)],
             states={
                 ASK_GPA_COURSE_COUNT: [
-                    MessageHandler(filters.Regex("^❌ إلغاء$"), self._cancel_gpa_calc),
+                    MessageHandler(_CANCEL_FILTER, self._cancel_gpa_calc),
                     MessageHandler(filters.TEXT & ~filters.COMMAND, self._gpa_ask_course_count)
                 ],
                 ASK_GPA_PERCENTAGE: [
-                    MessageHandler(filters.Regex("^❌ إلغاء$"), self._cancel_gpa_calc),
+                    MessageHandler(_CANCEL_FILTER, self._cancel_gpa_calc),
                     MessageHandler(filters.TEXT & ~filters.COMMAND, self._gpa_ask_percentage)
                 ],
                 ASK_GPA_ECTS: [
-                    MessageHandler(filters.Regex("^❌ إلغاء$"), self._cancel_gpa_calc),
+                    MessageHandler(_CANCEL_FILTER, self._cancel_gpa_calc),
                     MessageHandler(filters.TEXT & ~filters.COMMAND, self._gpa_ask_ects)
                 ],
             },
             fallbacks=[
                 CommandHandler("cancel", self._cancel_gpa_calc),
-                MessageHandler(filters.Regex("^❌ إلغاء$"), self._cancel_gpa_calc)
+                MessageHandler(_CANCEL_FILTER, self._cancel_gpa_calc)
             ],
             allow_reentry=True,
         )
         self.app.add_handler(gpa_calc_handler)
         # Move older_terms_handler above the generic handler
         older_terms_handler = ConversationHandler(
-            entry_points=[MessageHandler(filters.Regex("^📅 جميع الفصول$"), self._older_terms_command)],
+            entry_points=[MessageHandler(_OLDER_TERMS_FILTER, self._older_terms_command)],
             states={
                 ASK_OLDER_TERM_NUMBER: [MessageHandler(filters.TEXT & ~filters.COMMAND, self._ask_older_term_number)],
             },
-            fallbacks=[MessageHandler(filters.Regex("^❌ إلغاء$"), self._cancel_registration)],
+            fallbacks=[MessageHandler(_CANCEL_FILTER, self._cancel_registration)],
         )
         self.app.add_handler(older_terms_handler)
         # The generic handler must come after all ConversationHandlers
-        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self._handle_message))
+        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self._handle_message, block=False))
         self.app.add_handler(CallbackQueryHandler(self._settings_callback_handler, pattern="^(back_to_main|cancel_action)$"))
         settings_handler = ConversationHandler(
             entry_points=[CommandHandler("settings", self._settings_command)],
             states={
-                ASK_SETTINGS_MAIN: [MessageHandler(filters.Regex("^🔑 إدارة الجلسة/كلمة المرور$"), self._session_management_start)],
+                ASK_SETTINGS_MAIN: [MessageHandler(_SESSION_MANAGEMENT_FILTER, self._session_management_start)],
                 ASK_SESSION_MANAGEMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, self._handle_session_management)],
             },
-            fallbacks=[MessageHandler(filters.Regex("^🔙 العودة$"), self._return_to_main)],
+            fallbacks=[MessageHandler(_BACK_FILTER, self._return_to_main)],
         )
         self.app.add_handler(settings_handler)
 
     async def _send_message_with_keyboard(self, update, message, keyboard_type="main"):
-        keyboards = {
-            "main": get_main_keyboard, 
-            "admin": get_admin_keyboard, 
-            "cancel": get_cancel_keyboard, 
-            "unregistered": get_unregistered_keyboard,
-            "error_recovery": get_error_recovery_keyboard
-        }
-        await update.message.reply_text(message, reply_markup=keyboards.get(keyboard_type, get_main_keyboard)())
+        await update.message.reply_text(message, reply_markup=self._keyboards.get(keyboard_type, self._kb_main))
     
     async def _send_message_without_keyboard(self, update, message):
         """Send message and remove any existing keyboard."""
@@ -251,7 +635,7 @@ class TelegramBot:
         except Exception: pass 
 
     async def _start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user = self.user_storage.get_user(update.effective_user.id)
+        user = await self._get_user(update.effective_user.id)
         fullname = user.get('fullname') if user else None
         
         # Show user-friendly welcome message
@@ -265,31 +649,8 @@ class TelegramBot:
             await self._send_message_with_keyboard(update, welcome_message, "unregistered")
 
     async def _help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_id = update.effective_user.id
-        is_admin = user_id == CONFIG["ADMIN_ID"]
-        help_text = (
-            "🎓 دليل استخدام البوت\n\n"
-            "كيفية الاستخدام:\n"
-            "1. اضغط '🚀 تسجيل الدخول' وأدخل بياناتك الجامعية\n"
-            "2. استخدم الأزرار لفحص الدرجات والإعدادات\n"
-            "3. استعمل الأزرار للمساعدة أو الدعم الفني\n\n"
-            "الأوامر الأساسية:\n"
-            "/start - بدء الاستخدام\n"
-            "/help - المساعدة\n"
-            "/grades - التحقق من درجات الفصل الحالي\n"
-            "/old_grades - التحقق من درجات الفصل السابق\n"
-            "/profile - معلوماتي\n"
-            "/settings - الإعدادات\n"
-            "/support - الدعم الفني\n\n"
-            "أوامر الأمان:\n"
-            "/security_info - معلومات الأمان\n"
-            "/security_audit - تقرير التدقيق الأمني\n"
-            "/security_headers - معلومات معايير الأمان (للمطور فقط)\n"
-            "/privacy_policy - سياسة الخصوصية\n"
-        )
-        if is_admin:
-            help_text += "\nأوامر المدير:\n/security_stats - إحصائيات الأمان\n/admin - لوحة التحكم\n"
-        help_text += f"\n👨‍💻 المطور: {CONFIG.get('ADMIN_USERNAME', '@admin')}"
+        is_admin = update.effective_user.id == self._admin_id
+        help_text = HELP_TEXT_ADMIN if is_admin else HELP_TEXT_USER
         try:
             await update.message.reply_text(help_text)
         except Exception as e:
@@ -297,46 +658,30 @@ class TelegramBot:
 
     async def _security_info_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
-            from admin.dashboard import AdminDashboard
             security_info = AdminDashboard.get_user_security_info()
-            await update.message.reply_text(security_info, reply_markup=get_main_keyboard())
+            await update.message.reply_text(security_info, reply_markup=self._kb_main)
         except Exception as e:
-            await update.message.reply_text("عذراً، حدث خطأ أثناء عرض معلومات الأمان.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("عذراً، حدث خطأ أثناء عرض معلومات الأمان.", reply_markup=self._kb_main)
             logger.error(f"Error in _security_info_command: {e}", exc_info=True)
 
     async def _security_audit_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
-            audit_message = (
-                "📋 تقرير التدقيق الأمني:\n\n"
-                "• جميع العمليات في البوت تخضع لمراجعة دورية لضمان الأمان.\n"
-                "• لا يتم تخزين كلمات المرور أو مشاركتها مع أي جهة.\n"
-                "• نستخدم أحدث معايير الأمان لحماية بياناتك.\n\n"
-                "إذا كان لديك أي سؤال عن الأمان، تواصل مع الدعم الفني."
-            )
-            await update.message.reply_text(audit_message, reply_markup=get_main_keyboard())
+            await update.message.reply_text(SECURITY_AUDIT_MESSAGE, reply_markup=self._kb_main)
         except Exception as e:
-            await update.message.reply_text("عذراً، حدث خطأ أثناء عرض تقرير التدقيق.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("عذراً، حدث خطأ أثناء عرض تقرير التدقيق.", reply_markup=self._kb_main)
             logger.error(f"Error in _security_audit_command: {e}", exc_info=True)
 
     async def _privacy_policy_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
-            privacy_message = (
-                "🔒 سياسة الخصوصية:\n\n"
-                "• بياناتك الجامعية تُستخدم فقط لجلب الدرجات ولا يتم تخزين كلمة المرور نهائياً.\n"
-                "• جميع المعلومات مشفرة وآمنة ولا يتم مشاركتها مع أي جهة خارجية.\n"
-                "• يمكنك حذف بياناتك في أي وقت من خلال الدعم الفني.\n"
-                "• هدفنا هو حماية خصوصيتك وتقديم أفضل تجربة ممكنة.\n\n"
-                "لأي استفسار عن الخصوصية، تواصل مع الدعم الفني."
-            )
-            await update.message.reply_text(privacy_message, reply_markup=get_main_keyboard())
+            await update.message.reply_text(PRIVACY_POLICY_MESSAGE, reply_markup=self._kb_main)
         except Exception as e:
-            await update.message.reply_text("عذراً، حدث خطأ أثناء عرض سياسة الخصوصية.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("عذراً، حدث خطأ أثناء عرض سياسة الخصوصية.", reply_markup=self._kb_main)
             logger.error(f"Error in _privacy_policy_command: {e}", exc_info=True)
 
     async def _security_stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
-            if update.effective_user.id != CONFIG["ADMIN_ID"]:
-                await update.message.reply_text("🚫 هذا الأمر متاح للمدير فقط.", reply_markup=get_main_keyboard())
+            if update.effective_user.id != self._admin_id:
+                await update.message.reply_text("🚫 هذا الأمر متاح للمدير فقط.", reply_markup=self._kb_main)
                 return
             stats = security_manager.get_security_stats()
             
@@ -362,55 +707,46 @@ class TelegramBot:
                 f"⚠️ أحداث عالية الخطورة: {high_risk_events}\n\n"
                 "💡 هذه الإحصائيات تساعد في مراقبة الأمان"
             )
-            await update.message.reply_text(stats_message, reply_markup=get_main_keyboard())
+            await update.message.reply_text(stats_message, reply_markup=self._kb_main)
         except Exception as e:
-            await update.message.reply_text("عذراً، حدث خطأ أثناء جلب إحصائيات الأمان.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("عذراً، حدث خطأ أثناء جلب إحصائيات الأمان.", reply_markup=self._kb_main)
             logger.error(f"Error in _security_stats_command: {e}", exc_info=True)
 
     async def _security_headers_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
-            headers_message = (
-                "🛡️ معلومات الأمان:\n\n"
-                "• البوت يستخدم تقنيات حماية متقدمة لضمان سرية بياناتك.\n"
-                "• جميع الاتصالات مشفرة وآمنة.\n"
-                "• لا داعي للقلق بشأن الخصوصية أو الأمان.\n\n"
-                "لأي استفسار، تواصل مع الدعم الفني."
-            )
-            await update.message.reply_text(headers_message, reply_markup=get_main_keyboard())
+            await update.message.reply_text(SECURITY_HEADERS_MESSAGE, reply_markup=self._kb_main)
         except Exception as e:
-            await update.message.reply_text("عذراً، حدث خطأ أثناء جلب معلومات الأمان.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("عذراً، حدث خطأ أثناء جلب معلومات الأمان.", reply_markup=self._kb_main)
             logger.error(f"Error in _security_headers_command: {e}", exc_info=True)
 
     async def _grades_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Looked up inside the try; the error reply reuses it instead of querying storage again
+        user = None
         try:
             logger.info(f"🔍 _grades_command called for user {update.effective_user.id}")
             context.user_data['last_action'] = 'grades'
             telegram_id = update.effective_user.id
-            user = self.user_storage.get_user(telegram_id)
+            user = await self._get_user(telegram_id)
             logger.info(f"📊 User lookup result: {user is not None}")
             if not user:
                 logger.warning(f"❌ User {telegram_id} not found in storage")
-                await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=get_unregistered_keyboard())
+                await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=self._kb_unregistered)
                 return
             token = user.get("session_token")
             logger.info(f"🔑 Token found: {token is not None}")
             if not token:
                 logger.warning(f"❌ No token for user {telegram_id}")
-                await update.message.reply_text("❗️ يجب إعادة تسجيل الدخول.", reply_markup=get_unregistered_keyboard())
+                await update.message.reply_text("❗️ يجب إعادة تسجيل الدخول.", reply_markup=self._kb_unregistered)
                 return
             
-            # Test token validity first
-            logger.info(f"🔍 Testing token validity for user {telegram_id}")
-            if not await self.university_api.test_token(token):
-                logger.warning(f"❌ Invalid token for user {telegram_id}")
-                
+            logger.info(f"🌐 Calling get_user_data for user {telegram_id}")
+            try:
+                user_data = await self._fetch_fresh_user_data(user)
+            except InvalidTokenError:
                 # Token is invalid, force logout
                 logger.warning(f"❌ Invalid token for user {user.get('username', 'Unknown')}, forcing logout")
                 await self._force_logout_user(telegram_id, update)
                 return
-            
-            logger.info(f"🌐 Calling get_user_data for user {telegram_id}")
-            user_data = await self.university_api.get_user_data(token)
             logger.info(f"📊 User data result: {user_data is not None}")
             
             # Check if user_data is None (API error) or has no grades
@@ -424,89 +760,85 @@ class TelegramBot:
             
             if not grades:
                 logger.warning(f"⚠️ No grades found for user {telegram_id}")
-                await update.message.reply_text("لا يوجد درجات متاحة بعد.", reply_markup=get_main_keyboard())
+                await update.message.reply_text("لا يوجد درجات متاحة بعد.", reply_markup=self._kb_main)
                 return
 
-            # Always save grades to the grade table after fetching
-            self.grade_storage.store_grades(user.get('username'), grades)
+            # Save fetched grades (store_grades skips the write when they match the last ones stored)
+            await asyncio.to_thread(self.grade_storage.store_grades, user.get('username'), grades)
 
             # Format grades with quote
             logger.info(f"📝 Formatting grades for user {telegram_id}")
             message = await self.grade_analytics.format_current_grades_with_quote(telegram_id, grades)
             logger.info(f"✅ Sending formatted message to user {telegram_id}")
-            await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=get_main_keyboard())
+            await update.message.reply_text(message, parse_mode=ParseMode.HTML, reply_markup=self._kb_main)
         except Exception as e:
             logger.error(f"[ALERT] Error in _grades_command: {e}", exc_info=True)
-            admin_id = CONFIG.get("ADMIN_ID")
-            admin_username = CONFIG.get("ADMIN_USERNAME", "@admin")
+            admin_id = self._admin_id
+            admin_username = ADMIN_USERNAME
             if admin_id:
                 try:
                     await self.app.bot.send_message(chat_id=admin_id, text=f"[DB/UX ERROR] User: {update.effective_user.id}\nAction: grades\nError: {e}")
                 except Exception:
                     pass
-            is_registered = self.user_storage.is_user_registered(update.effective_user.id)
-            keyboard = get_main_keyboard() if is_registered else get_unregistered_keyboard()
+            keyboard = self._kb_main if user else self._kb_unregistered
             await update.message.reply_text(f"❌ حدث خطأ أثناء جلب الدرجات. إذا استمرت المشكلة، لا تتردد في التواصل مع المطور {admin_username}.", reply_markup=keyboard)
 
     async def _old_grades_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Looked up inside the try; the error reply reuses it instead of querying storage again
+        user = None
         try:
             context.user_data['last_action'] = 'old_grades'
             telegram_id = update.effective_user.id
-            user = self.user_storage.get_user(telegram_id)
+            user = await self._get_user(telegram_id)
             if not user:
-                await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=get_unregistered_keyboard())
+                await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=self._kb_unregistered)
                 return
             token = user.get("session_token")
             if not token:
-                await update.message.reply_text("❗️ يجب إعادة تسجيل الدخول.", reply_markup=get_unregistered_keyboard())
+                await update.message.reply_text("❗️ يجب إعادة تسجيل الدخول.", reply_markup=self._kb_unregistered)
                 return
             
-            # Test token validity first
+            # The old-grades pages don't report an invalid token, so check it alongside
+            # the fetch instead of before it
             logger.info(f"🔍 Testing token validity for user {telegram_id} (old grades)")
-            if not await self.university_api.test_token(token):
-                logger.warning(f"❌ Invalid token for user {telegram_id}")
-                
+            token_valid, old_grades = await asyncio.gather(
+                self.university_api.test_token(token),
+                self.university_api.get_old_grades(token),
+            )
+            if not token_valid:
                 # Token is invalid, force logout
                 logger.warning(f"❌ Invalid token for user {user.get('username', 'Unknown')}, forcing logout")
                 await self._force_logout_user(telegram_id, update)
                 return
             
-            old_grades = await self.university_api.get_old_grades(token)
             if old_grades is None:
                 logger.warning(f"❌ API error for user {telegram_id} (old grades), forcing logout")
                 await self._force_logout_user(telegram_id, update)
                 return
             if not old_grades:
-                await update.message.reply_text("📚 لا توجد درجات سابقة متاحة للفصل الدراسي السابق.", reply_markup=get_main_keyboard())
+                await update.message.reply_text("📚 لا توجد درجات سابقة متاحة للفصل الدراسي السابق.", reply_markup=self._kb_main)
                 return
             formatted_message = await self.grade_analytics.format_old_grades_with_analysis(telegram_id, old_grades)
-            # Split long messages if needed
-            if len(formatted_message) > 4096:
-                # Send message in chunks if too long
-                for i in range(0, len(formatted_message), 4096):
-                    await update.message.reply_text(formatted_message[i:i+4096], reply_markup=get_main_keyboard())
-            else:
-                await update.message.reply_text(formatted_message, reply_markup=get_main_keyboard())
+            await self._reply_long(update, formatted_message, reply_markup=self._kb_main)
         except Exception as e:
             logger.error(f"[ALERT] Error in _old_grades_command: {e}", exc_info=True)
-            admin_id = CONFIG.get("ADMIN_ID")
-            admin_username = CONFIG.get("ADMIN_USERNAME", "@admin")
+            admin_id = self._admin_id
+            admin_username = ADMIN_USERNAME
             if admin_id:
                 try:
                     await self.app.bot.send_message(chat_id=admin_id, text=f"[DB/UX ERROR] User: {update.effective_user.id}\nAction: old_grades\nError: {e}")
                 except Exception:
                     pass
             context.user_data.pop('last_action', None)
-            is_registered = self.user_storage.is_user_registered(update.effective_user.id)
-            keyboard = get_main_keyboard() if is_registered else get_unregistered_keyboard()
+            keyboard = self._kb_main if user else self._kb_unregistered
             await update.message.reply_text(f"❌ حدث خطأ غير متوقع أثناء جلب الدرجات السابقة. إذا استمرت المشكلة، لا تتردد في التواصل مع المطور {admin_username}.", reply_markup=keyboard)
 
     async def _profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             telegram_id = update.effective_user.id
-            user = self.user_storage.get_user(telegram_id)
+            user = await self._get_user(telegram_id)
             if not user:
-                await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=get_unregistered_keyboard())
+                await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=self._kb_unregistered)
                 return
             msg = (
                 f"👤 **معلوماتك الجامعية:**\n"
@@ -514,58 +846,40 @@ class TelegramBot:
                 f"• اسم المستخدم الجامعي: {user.get('username', '-')}\n"
             )
             try:
-                await update.message.reply_text(msg, reply_markup=get_main_keyboard())
+                await update.message.reply_text(msg, reply_markup=self._kb_main)
             except Exception as e:
                 logger.error(f"Error sending profile message: {e}")
-                await update.message.reply_text(msg, reply_markup=get_main_keyboard())
+                await update.message.reply_text(msg, reply_markup=self._kb_main)
         except Exception as e:
-            await update.message.reply_text("حدث خطأ أثناء جلب المعلومات.", reply_markup=get_unregistered_keyboard())
+            await update.message.reply_text("حدث خطأ أثناء جلب المعلومات.", reply_markup=self._kb_unregistered)
             logger.error(f"Error in _profile_command: {e}", exc_info=True)
 
     async def _settings_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_id = update.effective_user.id
-        user = self.user_storage.get_user_by_telegram_id(user_id)
-        
-        await update.message.reply_text(
-            "⚙️ إعدادات الحساب\n\n"
-            "يمكنك التحكم في بياناتك والوصول إلى خيارات الخصوصية.\n"
-            "كل شيء في هذا البوت شفاف ويمكنك دائماً معرفة كيف يتم التعامل مع بياناتك.\n\n"
-            "- يمكنك زيارة الكود البرمجي على GitHub.",
-            reply_markup=get_settings_main_keyboard()
-        )
+        await update.message.reply_text(SETTINGS_MESSAGE, reply_markup=get_settings_main_keyboard())
         return ASK_SETTINGS_MAIN
 
-    def _get_contact_support_keyboard(self):
-        """Returns an inline keyboard with a Contact Support button."""
-        admin_username = CONFIG.get("ADMIN_USERNAME", "@admin")
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("📞 تواصل مع الدعم الفني", url=f"https://t.me/{admin_username.lstrip('@')}")]
-        ])
-
     async def _support_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
-            admin_username = CONFIG.get("ADMIN_USERNAME", "@admin")
-            await update.message.reply_text(
-                f"📞 للدعم الفني: {admin_username}\nاضغط الزر أدناه للتواصل مباشرة.",
-                reply_markup=self._get_contact_support_keyboard()
-            )
+            await update.message.reply_text(SUPPORT_MESSAGE, reply_markup=get_contact_support_inline_keyboard())
         except Exception as e:
-            await update.message.reply_text("عذراً، حدث خطأ أثناء عرض الدعم.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("عذراً، حدث خطأ أثناء عرض الدعم.", reply_markup=self._kb_main)
             logger.error(f"Error in _support_command: {e}", exc_info=True)
 
     async def _admin_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Show admin dashboard for admin users
-        if update.effective_user.id == CONFIG["ADMIN_ID"]:
+        if update.effective_user.id == self._admin_id:
             await self.admin_dashboard.show_dashboard(update, context)
         else:
-            await update.message.reply_text("🚫 ليس لديك صلاحية لهذه العملية.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("🚫 ليس لديك صلاحية لهذه العملية.", reply_markup=self._kb_main)
 
     async def _handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = update.message.text
         user_id = update.effective_user.id
-        is_registered = self.user_storage.is_user_registered(user_id)
+        # One storage lookup per update; every reply below picks its keyboard from this
+        user = await self._get_user(user_id)
+        is_registered = user is not None
         if text == "❌ إلغاء":
-            keyboard = get_main_keyboard() if is_registered else get_unregistered_keyboard()
+            keyboard = self._kb_main if is_registered else self._kb_unregistered
             await update.message.reply_text(
                 "✅ تم إلغاء العملية. يمكنك البدء من جديد أو اختيار إجراء آخر.",
                 reply_markup=keyboard
@@ -573,107 +887,40 @@ class TelegramBot:
             context.user_data.clear()
             return
         try:
-            # Admin: user search
-            if user_id == CONFIG["ADMIN_ID"] and context.user_data.get('awaiting_user_search'):
-                handled = await self.admin_dashboard.handle_user_search_message(update, context)
-                if handled:
-                    context.user_data.pop('awaiting_user_search', None)
-                    return
-            # Admin: user delete
-            if user_id == CONFIG["ADMIN_ID"] and context.user_data.get('awaiting_user_delete'):
-                handled = await self.admin_dashboard.handle_user_delete_message(update, context)
-                if handled:
-                    context.user_data.pop('awaiting_user_delete', None)
-                    return
-            # Admin: broadcast
-            if user_id == CONFIG["ADMIN_ID"] and context.user_data.get('awaiting_broadcast'):
-                handled = await self.admin_dashboard.handle_dashboard_message(update, context)
-                if handled:
-                    context.user_data.pop('awaiting_broadcast', None)
-                    return
+            # Admin: pending search/delete/broadcast prompt
+            if user_id == self._admin_id and not _ADMIN_AWAITING_KEYS.isdisjoint(context.user_data):
+                for flag, handler_name in _ADMIN_AWAITING_DISPATCH:
+                    if context.user_data.get(flag):
+                        handled = await getattr(self.admin_dashboard, handler_name)(update, context)
+                        if handled:
+                            context.user_data.pop(flag, None)
+                            return
             # Admin: force grade check
             if context.user_data.get("awaiting_force_grade_check"):
                 handled = await self.admin_dashboard.handle_force_grade_check_message(update, context)
                 if handled:
                     return
-            # Handle error recovery buttons
-            # If the user presses a session type button outside registration, show the welcome message and keyboard
-            if text in [
-                "🔒 جلسة مؤقتة (لا يتم تخزين كلمة المرور)",
-                "🔑 جلسة دائمة (تخزين كلمة المرور مشفر)"
-            ]:
-                user = self.user_storage.get_user(user_id)
-                if user:
-                    from utils.messages import get_welcome_message
-                    welcome_message = get_welcome_message(user.get('fullname'))
-                    await update.message.reply_text(welcome_message, reply_markup=get_main_keyboard())
-                else:
-                    from utils.messages import get_simple_welcome_message
-                    await update.message.reply_text(get_simple_welcome_message(), reply_markup=get_unregistered_keyboard())
-                return
-            # Map button text to actions
-            actions = {
-                # Grade actions
-                "📊 درجات الفصل الحالي": self._grades_command,
-                "📚 درجات الفصل السابق": self._old_grades_command,
-                # User actions
-                "👤 معلوماتي الشخصية": self._profile_command,
-                "⚙️ الإعدادات والتخصيص": self._settings_command,
-                # Support/help
-                "📞 الدعم الفني": self._support_command,
-                "❓ المساعدة والدليل": self._help_command,
-                # Registration
-                "🚀 تسجيل الدخول للجامعة": self._register_start,
-                # Admin
-                "🎛️ لوحة التحكم الإدارية": self._admin_command,
-                "🔙 العودة للوحة الرئيسية": self._return_to_main,
-                # Legacy button support
-                "📊 التحقق من درجات الفصل الحالي": self._grades_command,
-                "📚 التحقق من درجات الفصل السابق": self._old_grades_command,
-                "👤 معلوماتي": self._profile_command,
-                "⚙️ الإعدادات": self._settings_command,
-                "📞 الدعم": self._support_command,
-                "❓ المساعدة": self._help_command,
-                "🚀 تسجيل الدخول": self._register_start,
-                "🎛️ لوحة التحكم": self._admin_command,
-                "🔙 العودة": self._return_to_main,
-                # Info about bot
-                "❓ كيف يعمل البوت؟": self._how_it_works_command,
-                # Logout
-                "🚪 تسجيل الخروج": self._logout_command,
-                # Refresh keyboard
-                "🔄 تحديث الأزرار": self._refresh_keyboard,
-                "🧮 حساب المعدل المخصص": self._gpa_calc_start,
-                "📅 جميع الفصول": self._older_terms_command,
-                "📥 تحميل معلوماتي": self._download_my_info_command,
-            }
-            action = actions.get(text)
+            action = self._button_actions.get(text)
             if action:
                 await action(update, context)
                 return
-            else:
-                is_registered = self.user_storage.is_user_registered(user_id)
-                keyboard = get_main_keyboard() if is_registered else get_unregistered_keyboard()
-                await update.message.reply_text(
-                    "هذه الميزة قيد التطوير. سيتم توفيرها قريباً.\n\n📞 للمساعدة: اضغط '📞 الدعم الفني' أو الزر أدناه.",
-                    reply_markup=keyboard
-                )
+            keyboard = self._kb_main if is_registered else self._kb_unregistered
+            await update.message.reply_text(UNKNOWN_BUTTON_MESSAGE, reply_markup=keyboard)
         except Exception as e:
             logger.error(f"[ALERT] Error in _handle_message: {e}", exc_info=True)
-            admin_id = CONFIG.get("ADMIN_ID")
-            admin_username = CONFIG.get("ADMIN_USERNAME", "@admin")
-            if admin_id:
+            # Registration state comes from the lookup made before the try, so the
+            # error path adds no storage work; admin alerts are throttled
+            now = asyncio.get_running_loop().time()
+            last_alert = self._last_admin_error_alert
+            if self._admin_id and (last_alert is None or now - last_alert >= ADMIN_ERROR_ALERT_INTERVAL_SECONDS):
+                self._last_admin_error_alert = now
                 try:
-                    await self.app.bot.send_message(chat_id=admin_id, text=f"[UX ERROR] User: {user_id}\nAction: {text}\nError: {e}")
+                    await self.app.bot.send_message(chat_id=self._admin_id, text=f"[UX ERROR] User: {user_id}\nAction: {text}\nError: {e}")
                 except Exception:
                     pass
             context.user_data.clear()
-            is_registered = self.user_storage.is_user_registered(user_id)
-            keyboard = get_main_keyboard() if is_registered else get_unregistered_keyboard()
-            await update.message.reply_text(
-                f"❌ حدث خطأ غير متوقع\n\n**الحلول:**\n• جرب مرة أخرى بعد قليل\n• إذا استمرت المشكلة، لا تتردد في التواصل مع المطور {admin_username}\n• تأكد من اتصالك بالإنترنت\n\n📞 للمساعدة: اضغط '📞 الدعم الفني' أو الزر أدناه.",
-                reply_markup=keyboard
-            )
+            keyboard = self._kb_main if is_registered else self._kb_unregistered
+            await update.message.reply_text(UNEXPECTED_ERROR_MESSAGE, reply_markup=keyboard)
 
     async def _handle_error_recovery(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle error recovery actions from the error recovery keyboard."""
@@ -699,7 +946,7 @@ class TelegramBot:
                     logger.error(f"Error in retry action: {e}")
                     await update.message.reply_text(
                         "❌ فشلت إعادة المحاولة. يرجى المحاولة مرة أخرى لاحقاً.",
-                        reply_markup=get_error_recovery_keyboard()
+                        reply_markup=self._kb_error
                     )
             else:
                 await self._start_command(update, context)
@@ -715,137 +962,162 @@ class TelegramBot:
 
     async def _handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        await query.answer()
-        
         # Handle specific user callbacks first (regardless of admin status)
-        user_id = update.effective_user.id
-        user = self.user_storage.get_user_by_telegram_id(user_id)
-        
-        # Translation toggle is disabled for now
-        
-        if query.data == "delete_user_data":
-            if not user:
-                await query.edit_message_text("❗️ يجب التسجيل أولاً.")
-                return
-            # Show confirmation for data deletion
-            await query.edit_message_text(
-                "🗑️ **حذف البيانات الشخصية**\n\n"
-                "⚠️ **تحذير**: هذا الإجراء سيحذف:\n"
-                "• جميع بياناتك المخزنة\n"
-                "• كلمة المرور المشفرة\n"
-                "• إعداداتك الشخصية\n"
-                "• سجل الدرجات\n\n"
-                "❌ **لا يمكن التراجع عن هذا الإجراء**\n\n"
-                "هل أنت متأكد من حذف جميع بياناتك؟",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ نعم، احذف جميع بياناتي", callback_data="confirm_delete_data")],
-                    [InlineKeyboardButton("❌ إلغاء", callback_data="cancel_delete_data")]
-                ])
-            )
-            return
-            
-        elif query.data == "confirm_delete_data":
-            if not user:
-                await query.edit_message_text("❗️ يجب التسجيل أولاً.")
-                return
-            # Delete user data
-            try:
-                # Delete user from storage
-                self.user_storage.delete_user(user["username"])
-                # Delete grades
-                self.grade_storage.delete_user_grades(user["username"])
-                await query.edit_message_text(
-                    "✅ تم حذف جميع بياناتك بنجاح.\n\n"
-                    "تم تسجيل خروجك تلقائياً. يمكنك التسجيل مرة أخرى إذا أردت.",
-                    reply_markup=get_unregistered_keyboard()
-                )
-            except Exception as e:
-                await query.edit_message_text(
-                    f"❌ حدث خطأ أثناء حذف البيانات: {str(e)}\n\n"
-                    "يرجى المحاولة مرة أخرى أو التواصل مع الدعم الفني."
-                )
-            return
-            
-        elif query.data == "cancel_delete_data":
-            # Return to privacy settings
-            await query.edit_message_text(
-                "تم إلغاء حذف البيانات.",
-                reply_markup=get_privacy_settings_keyboard()
-            )
-            return
-        
-        elif query.data == "back_to_settings":
-            # Return to main settings
-            from utils.keyboards import get_settings_main_keyboard
-            keyboard = get_settings_main_keyboard()
-            await query.edit_message_text(
-                "تمت العودة إلى الإعدادات الرئيسية.",
-                reply_markup=keyboard
-            )
-            return
+        handler = self._settings_callbacks.get(query.data)
         
-        # Handle admin callbacks (after specific user callbacks)
-        if update.effective_user.id == CONFIG["ADMIN_ID"]:
+        # Handle admin callbacks (after specific user callbacks); the dashboard answers the query itself
+        if handler is None and update.effective_user.id == self._admin_id:
             await self.admin_dashboard.handle_callback(update, context)
             return
-            
-        # Delegate other callbacks to settings handler
-        await self._settings_callback_handler(update, context)
+        
+        await query.answer()
+        user = await self._get_user(update.effective_user.id)
+        await (handler or self._cb_unknown)(update, query, user)
 
     async def _admin_notify_grades(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if update.effective_user.id != CONFIG["ADMIN_ID"]:
-            await update.message.reply_text("🚫 ليس لديك صلاحية لهذه العملية.", reply_markup=get_main_keyboard())
+        if update.effective_user.id != self._admin_id:
+            await update.message.reply_text("🚫 ليس لديك صلاحية لهذه العملية.", reply_markup=self._kb_main)
             return
         await update.message.reply_text("🔄 جاري فحص الدرجات لجميع المستخدمين...")
         count = await self._notify_all_users_grades()
-        await update.message.reply_text(f"✅ تم فحص الدرجات وإشعار {count} مستخدم (إذا كان هناك تغيير).", reply_markup=get_main_keyboard())
+        await update.message.reply_text(f"✅ تم فحص الدرجات وإشعار {count} مستخدم (إذا كان هناك تغيير).", reply_markup=self._kb_main)
+
+    async def _run_background_job(self, name, job):
+        """Run a periodic job under the shared background-job semaphore; errors are logged, not raised"""
+        async with self._background_jobs:
+            try:
+                return await job()
+            except Exception as e:
+                logger.error(f"❌ Exception in background job '{name}': {e}", exc_info=True)
+                return None
 
     async def _grade_checking_loop(self):
         logger.info("🚦 Entered _grade_checking_loop (unconditional)")
-        try:
-            await asyncio.sleep(10)
-            logger.info("🚦 Slept 10 seconds, entering infinite loop")
-            while True:
-                logger.info("🔔 Running scheduled grade check for all users (unconditional)...")
-                await self._notify_all_users_grades()
-                interval = int(CONFIG.get('GRADE_CHECK_INTERVAL', 10)) * 60
-                logger.info(f"🚦 Sleeping for {interval} seconds before next check (unconditional)")
-                await asyncio.sleep(interval)
-        except Exception as e:
-            logger.error(f"❌ Exception in _grade_checking_loop: {e}", exc_info=True)
+        await asyncio.sleep(10)
+        logger.info("🚦 Slept 10 seconds, entering infinite loop")
+        while True:
+            logger.info("🔔 Running scheduled grade check for all users (unconditional)...")
+            # A failed sweep no longer ends the loop; the next one runs on schedule
+            await self._run_background_job("grade check", self._notify_all_users_grades)
+            # ±GRADE_CHECK_JITTER spread keeps restarted instances from sweeping the university API in lockstep
+            base_interval = int(CONFIG.get('GRADE_CHECK_INTERVAL', 10)) * 60
+            interval = base_interval * (1 + random.uniform(-GRADE_CHECK_JITTER, GRADE_CHECK_JITTER))
+            logger.info(f"🚦 Sleeping for {interval:.0f} seconds before next check (unconditional)")
+            await asyncio.sleep(interval)
 
     async def _notify_all_users_grades(self):
-        users = self.user_storage.get_all_users()
+        users = await asyncio.to_thread(self.user_storage.get_all_users, use_cache=False)
         logger.info(f"🔍 Force grade check: Found {len(users)} users in database")
         
         if not users:
             logger.warning("⚠️ No users found in database for grade check")
             return 0
             
-        notified_count = 0
-        semaphore = asyncio.Semaphore(CONFIG.get('MAX_CONCURRENT_REQUESTS', 5))
-        tasks = []
-        results = []
-
-        async def check_user(user):
-            async with semaphore:
-                try:
-                    logger.debug(f"🔍 Checking grades for user: {user.get('username', 'Unknown')} (ID: {user.get('telegram_id', 'Unknown')})")
-                    return await self._check_and_notify_user_grades(user)
-                except Exception as e:
-                    logger.error(f"❌ Error in parallel grade check for user {user.get('username', 'Unknown')}: {e}", exc_info=True)
-                    return False
-
-        for user in users:
-            tasks.append(asyncio.create_task(check_user(user)))
-        if tasks:
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            notified_count = sum(1 for r in results if r is True)
+        # Users are fed to a fixed pool of workers page by page through a bounded queue,
+        # so only about two pages of stored grades are held at once. Each page's stored
+        # grades come from one query, limited to users without a stored-grades signature
+        # (the rest usually stop at the signature check); users missing from the map
+        # (or a whole page, if the query failed) are read individually in the check.
+        worker_count = min(CONFIG.get('MAX_CONCURRENT_REQUESTS', 5), len(users))
+        queue = asyncio.Queue(maxsize=GRADE_CHECK_PAGE_SIZE)
+
+        async def produce():
+            for start in range(0, len(users), GRADE_CHECK_PAGE_SIZE):
+                page = users[start:start + GRADE_CHECK_PAGE_SIZE]
+                usernames = [u.get("username_unique") or u.get("username") for u in page]
+                usernames = [name for name in usernames if name and not self.grade_storage.has_grades_signature(name)]
+                stored_grades = {}
+                if usernames:
+                    stored_grades = await asyncio.to_thread(self.grade_storage.get_users_grades_bulk, usernames) or {}
+                for user in page:
+                    await queue.put((user, stored_grades))
+            for _ in range(worker_count):
+                await queue.put(None)
+
+        # Expired-session flag changes are collected per username and written in two bulk updates
+        expired_updates = {}
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(produce())
+            workers = [
+                tg.create_task(self._grade_check_worker(queue, expired_updates))
+                for _ in range(worker_count)
+            ]
+        notified_count = sum(worker.result() for worker in workers)
+        for flag in (True, False):
+            changed = [name for name, value in expired_updates.items() if value is flag]
+            if changed:
+                await asyncio.to_thread(self.user_storage.update_token_expired_notified_bulk, changed, flag)
         
         logger.info(f"📊 Force grade check completed: {notified_count}/{len(users)} users notified")
         return notified_count
 
-    async def _check_and_notify_user_grades(self, user):
+    async def _grade_check_worker(self, queue, expired_updates=None):
+        """Check queued (user, stored_grades) items until a None sentinel; return how many were notified."""
+        notified_count = 0
+        while True:
+            item = await queue.get()
+            if item is None:
+                return notified_count
+            user, stored_grades = item
+            try:
+                logger.debug(f"🔍 Checking grades for user: {user.get('username', 'Unknown')} (ID: {user.get('telegram_id', 'Unknown')})")
+                # A stalled request costs one worker at most this long instead of hanging the sweep
+                async with self._grade_check_slots, asyncio.timeout(GRADE_CHECK_USER_TIMEOUT_SECONDS):
+                    notified = await self._check_and_notify_user_grades(user, stored_grades, expired_updates)
+                if notified is True:
+                    notified_count += 1
+            except TimeoutError:
+                logger.warning(f"⏱️ Grade check timed out for user {user.get('username', 'Unknown')}")
+            except Exception as e:
+                logger.warning(
+                    f"❌ Error in parallel grade check for user {user.get('username', 'Unknown')}: {e}",
+                    exc_info=logger.isEnabledFor(logging.DEBUG),
+                )
+
+    async def _pace_send(self):
+        """Space grade notifications so concurrent checks stay under Telegram's send limit."""
+        async with self._send_pace_lock:
+            now = asyncio.get_running_loop().time()
+            wait = self._next_send_at - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._next_send_at = max(now, self._next_send_at) + 1 / BROADCAST_MESSAGES_PER_SECOND
+
+    async def _set_expired_notified(self, user, notified, pending=None):
+        """Record the expired-session notification flag, or queue it in pending for a bulk write."""
+        if pending is not None:
+            pending[user["username"]] = notified
+        else:
+            await asyncio.to_thread(self.user_storage.update_token_expired_notified, user["username"], notified)
+
+    async def _fetch_fresh_user_data(self, user):
+        """Fetch the user's data and grades with their session token.
+
+        get_user_data validates the token as part of the fetch, so no separate test_token
+        round-trip is needed. A rejected token is replaced once through auto-login when a
+        password is stored (the new token is saved). Raises InvalidTokenError when no valid
+        token can be obtained; returns None on other API failures.
+        """
+        username = user.get("username")
+        try:
+            return await self.university_api.get_user_data(user.get("session_token"))
+        except InvalidTokenError:
+            if not (user.get("password_stored") and user.get("encrypted_password")):
+                raise
+        logger.info(f"🔑 Token rejected for user {username}, trying auto-login")
+        try:
+            new_token = await self.university_api.login(username, decrypt_password(user["encrypted_password"]))
+        except Exception as e:
+            logger.warning(f"❌ Auto-login failed for user {username}: {e}")
+            new_token = None
+        if not new_token:
+            raise InvalidTokenError("auto-login failed")
+        logger.info(f"🔑 Auto-login successful for user {username}, updating token.")
+        user["session_token"] = new_token
+        await asyncio.to_thread(self.user_storage.update_user, username, {"session_token": new_token})
+        return await self.university_api.get_user_data(new_token)
+
+    async def _check_and_notify_user_grades(self, user, stored_grades=None, expired_updates=None):
         try:
             telegram_id = user.get("telegram_id")
             username = user.get("username")
@@ -858,10 +1130,8 @@ class TelegramBot:
             token = user.get("session_token")
             logger.info(f"[CALL] _check_and_notify_user_grades for username={username}, username_unique={username_unique}, telegram_id={telegram_id}")
             logger.info(f"[CHECK] self.grade_storage is type: {type(self.grade_storage)}")
-            lock = self._get_user_lock(username_unique)
-            # --- Fix: Always initialize notified and is_pg ---
+            lock = self._get_user_lock(storage_username)
             notified = user.get("session_expired_notified", False)
-            is_pg = hasattr(self.user_storage, 'update_token_expired_notified')
             async with lock:
                 # Notify only once if token expired
                 if not token:
@@ -871,87 +1141,47 @@ class TelegramBot:
                         await self.app.bot.send_message(
                             chat_id=telegram_id,
                             text="⏰ انتهت صلاحية الجلسة\n\nتم تسجيل الخروج تلقائياً لحماية حسابك. يرجى تسجيل الدخول مرة أخرى من خلال زر '🚀 تسجيل الدخول للجامعة'.",
-                            reply_markup=get_unregistered_keyboard()
+                            reply_markup=self._kb_unregistered
                         )
-                        is_pg = hasattr(self.user_storage, 'update_token_expired_notified')
-                        if is_pg:
-                            self.user_storage.update_token_expired_notified(user["username"], True)
-                        else:
-                            user["session_expired_notified"] = True
-                            if hasattr(self.user_storage, '_save_users'):
-                                self.user_storage._save_users()
+                        await self._set_expired_notified(user, True, expired_updates)
                     return False
-                # Test token validity
-                if not await self.university_api.test_token(token):
+                logger.debug(f"🔍 Fetching user data for {username}")
+                try:
+                    user_data = await self._fetch_fresh_user_data(user)
+                except InvalidTokenError:
                     logger.warning(f"❌ Token expired for user {username}")
-                    # Try auto-login if password is stored
-                    if user.get("password_stored") and user.get("encrypted_password"):
-                        try:
-                            from utils.crypto import decrypt_password
-                            decrypted_password = decrypt_password(user["encrypted_password"])
-                            new_token = await self.university_api.login(user["username"], decrypted_password)
-                            if new_token:
-                                logger.info(f"🔑 Auto-login successful for user {username}, updating token.")
-                                # Update token in storage
-                                user["token"] = new_token
-                                self.user_storage.save_user(
-                                    telegram_id,
-                                    user["username"],
-                                    new_token,
-                                    user,
-                                    encrypted_password=user["encrypted_password"],
-                                    password_stored=True,
-                                    password_consent_given=user.get("password_consent_given", True)
-                                )
-                                # Retry grade check with new token
-                                token = new_token
-
-                            else:
-                                logger.warning(f"❌ Auto-login failed for user {username}")
-                                return False
-                        except Exception as e:
-                            logger.warning(f"❌ Auto-login failed for user {username}")
-                            return False
-                    else:
-                        # Token is invalid, notify user to login manually
-                        if not notified:
-                            await self.app.bot.send_message(
-                                chat_id=telegram_id,
-                                text="⏰ انتهت صلاحية الجلسة\n\nيرجى تسجيل الدخول مرة أخرى من خلال زر '🚀 تسجيل الدخول للجامعة' ثم إدخال بياناتك من جديد. هذا طبيعي ويحدث كل فترة.",
-                                reply_markup=get_unregistered_keyboard()
-                            )
-                            if is_pg:
-                                self.user_storage.update_token_expired_notified(user["username"], True)
-                            else:
-                                user["session_expired_notified"] = True
-                                if hasattr(self.user_storage, '_save_users'):
-                                    self.user_storage._save_users()
-                        return False
+                    # Users with a stored password were already retried via auto-login;
+                    # the rest are asked (once) to log in again
+                    if not (user.get("password_stored") and user.get("encrypted_password")) and not notified:
+                        await self.app.bot.send_message(
+                            chat_id=telegram_id,
+                            text="⏰ انتهت صلاحية الجلسة\n\nيرجى تسجيل الدخول مرة أخرى من خلال زر '🚀 تسجيل الدخول للجامعة' ثم إدخال بياناتك من جديد. هذا طبيعي ويحدث كل فترة.",
+                            reply_markup=self._kb_unregistered
+                        )
+                        await self._set_expired_notified(user, True, expired_updates)
+                    return False
                 logger.debug(f"✅ Token valid for user {username}")
                 # Reset notification flag if token is valid
                 if notified:
-                    if is_pg:
-                        self.user_storage.update_token_expired_notified(user["username"], False)
-                    else:
-                        # Update file storage
-                        user["session_expired_notified"] = False
-                        if hasattr(self.user_storage, '_save_users'):
-                            self.user_storage._save_users()
-                logger.debug(f"🔍 Fetching user data for {username}")
-                user_data = await self.university_api.get_user_data(token)
+                    await self._set_expired_notified(user, False, expired_updates)
                 if not user_data or "grades" not in user_data:
                     logger.info(f"No grade data available for {username} in this check.")
                     return False
                 new_grades = user_data.get("grades", [])
                 logger.debug(f"📊 Found {len(new_grades)} new grades for user {username}")
+                # Same payload as the last one stored: nothing to diff, store, or notify
+                if self.grade_storage.grades_unchanged(storage_username, new_grades):
+                    logger.debug(f"✅ Grades for {storage_username} unchanged since last check")
+                    return False
                 # Use storage_username for grade storage
-                old_grades = []
+                old_grades = (stored_grades or {}).get(storage_username)
                 try:
-                    old_grades = self.grade_storage.get_user_grades(storage_username)
+                    if old_grades is None:
+                        old_grades = await asyncio.to_thread(self.grade_storage.get_user_grades, storage_username)
                 except Exception as db_exc:
                     logger.error(f"[ALERT] Persistent DB error for user {storage_username}: {db_exc}")
                     # Alert admin
-                    admin_id = CONFIG.get("ADMIN_ID")
+                    admin_id = self._admin_id
                     if admin_id:
                         try:
                             await self.app.bot.send_message(chat_id=admin_id, text=f"[DB ERROR] Persistent DB error for user {storage_username}: {db_exc}")
@@ -960,7 +1190,8 @@ class TelegramBot:
                     return False
                 logger.debug(f"📊 Found {len(old_grades) if old_grades else 0} stored grades for user {storage_username}")
                 
-                # Get user's grade notification sensitivity setting
+                # Get user's grade notification sensitivity setting (on the loop: UserSettings
+                # rewrites one JSON file unlocked, so concurrent threads could lose or wipe settings)
                 user_settings = self.user_settings.get_user_settings(telegram_id)
                 sensitivity = user_settings.get("notifications", {}).get("grade_sensitivity", "meaningful")
                 logger.debug(f"🔍 User {username_unique} grade sensitivity setting: {sensitivity}")
@@ -968,50 +1199,51 @@ class TelegramBot:
                 changed_courses = self._compare_grades(old_grades, new_grades, sensitivity)
                 logger.debug(f"🔍 Grade comparison for {storage_username}: {len(changed_courses)} {sensitivity} changes detected")
                 # Always save the grades, regardless of notification
-                self.grade_storage.store_grades(storage_username, new_grades)
+                await asyncio.to_thread(self.grade_storage.store_grades, storage_username, new_grades)
                 if not changed_courses:
                     logger.debug(f"✅ No {sensitivity} grade changes for user {storage_username}, not sending notification.")
                     return False
                 
                 # Create appropriate message based on sensitivity
-                if sensitivity == "all":
-                    message = f"🎓 تم تحديث درجاتك في المواد التالية:\n\n"
-                elif sensitivity == "significant":
-                    message = f"🎓 تم تحديث درجاتك بشكل كبير في المواد التالية:\n\n"
-                else:  # meaningful
-                    message = f"🎓 تم تحديث درجاتك في المواد التالية:\n\n"
+                if sensitivity == "significant":
+                    parts = ["🎓 تم تحديث درجاتك بشكل كبير في المواد التالية:\n\n"]
+                else:  # all / meaningful
+                    parts = ["🎓 تم تحديث درجاتك في المواد التالية:\n\n"]
                 old_map = {g.get('code') or g.get('name'): g for g in old_grades if g.get('code') or g.get('name')}
                 
                 for grade in changed_courses:
-                    name = grade.get('name', 'N/A')
-                    code = grade.get('code', '-')
-                    key = code if code != '-' else name
-                    old = old_map.get(key, {})
-
-                    def show_change(field, label):
-                        old_val = old.get(field, '—')
-                        new_val = grade.get(field, '—')
-                        # Always show old and new, even if old was missing or 'لم يتم النشر'
-                        return f"{label}: {old_val} → {new_val}" if old_val != new_val else None
-
-                    changes = [
-                        show_change('coursework', 'الأعمال'),
-                        show_change('final_exam', 'النظري'),
-                        show_change('total', 'النهائي'),
-                    ]
-                    changes = [c for c in changes if c]
+                    grade_get = grade.get
+                    name = grade_get('name', 'N/A')
+                    code = grade_get('code', '-')
+                    # Same key as old_map (and _compare_grades): code, falling back to name
+                    old_get = old_map.get(grade_get('code') or grade_get('name'), {}).get
+
+                    # Always show old and new, even if old was missing or 'لم يتم النشر'
+                    changes = []
+                    for grade_field, label in GRADE_CHANGE_FIELDS:
+                        old_val = old_get(grade_field, '—')
+                        new_val = grade_get(grade_field, '—')
+                        if old_val != new_val:
+                            changes.append(f"{label}: {old_val} → {new_val}")
 
                     if changes:
-                        message += f"📚 {name} ({code})\n" + "\n".join(changes) + "\n\n"
+                        parts.append(f"📚 {name} ({code})\n")
+                        parts.append("\n".join(changes))
+                        parts.append("\n\n")
                 
                 # If we reach here, we have meaningful changes to report
-                now_utc3 = datetime.now(timezone.utc) + timedelta(hours=3)
-                message += f"🕒 وقت التحديث: {now_utc3.strftime('%Y-%m-%d %H:%M')} (UTC+3)"
+                parts.append(f"🕒 وقت التحديث: {_update_timestamp()} (UTC+3)")
+                message = "".join(parts)
+                await self._pace_send()
                 await self.app.bot.send_message(chat_id=telegram_id, text=message)
                 logger.info(f"✅ Sent grade change notification to user {username_unique}")
                 return True
         except Exception as e:
-            logger.error(f"❌ Error in _check_and_notify_user_grades for user {user.get('username', 'Unknown')}: {e}", exc_info=True)
+            # Runs once per user per sweep; an API outage would otherwise format a traceback for every user
+            logger.warning(
+                f"❌ Error in _check_and_notify_user_grades for user {user.get('username', 'Unknown')}: {e}",
+                exc_info=logger.isEnabledFor(logging.DEBUG),
+            )
             return False
 
     def _compare_grades(self, old_grades: List[Dict], new_grades: List[Dict], sensitivity: str = "meaningful") -> List[Dict]:
@@ -1024,12 +1256,7 @@ class TelegramBot:
         - "significant": Only notify about significant grade changes (e.g., letter grade changes)
         """
         def extract_relevant(grade):
-            return {
-                'code': grade.get('code') or grade.get('name'),
-                'total': grade.get('total'),
-                'coursework': grade.get('coursework'),
-                'final_exam': grade.get('final_exam'),
-            }
+            return (grade.get('total'), grade.get('coursework'), grade.get('final_exam'))
         
         def is_meaningful_grade(value):
             """Check if a grade value is meaningful (not empty, None, or 'لم يتم النشر')"""
@@ -1076,7 +1303,21 @@ class TelegramBot:
                 # If we can't parse as numbers, treat as letter grades
                 return old_val != new_val
         
-        old_map = {g.get('code') or g.get('name'): extract_relevant(g) for g in old_grades if g.get('code') or g.get('name')}
+        # Choose comparison function based on sensitivity
+        if sensitivity == "all":
+            def compare_func(old_val, new_val):
+                return old_val != new_val
+        elif sensitivity == "significant":
+            compare_func = has_significant_change
+        else:  # "meaningful" (default)
+            compare_func = has_meaningful_change
+
+        # course key -> (total, coursework, final_exam)
+        old_map = {}
+        for g in old_grades:
+            key = g.get('code') or g.get('name')
+            if key:
+                old_map[key] = extract_relevant(g)
         changed = []
         
         for new_grade in new_grades:
@@ -1096,19 +1337,16 @@ class TelegramBot:
                     logger.debug(f"📝 New course '{key}' found, skipping notification (sensitivity: {sensitivity})")
                 continue
             
-            # Choose comparison function based on sensitivity
-            if sensitivity == "all":
-                def compare_func(old_val, new_val):
-                    return old_val != new_val
-            elif sensitivity == "significant":
-                compare_func = has_significant_change
-            else:  # "meaningful" (default)
-                compare_func = has_meaningful_change
+            # Identical fields never count as a change at any sensitivity
+            if relevant_old == relevant_new:
+                continue
             
             # Check for changes in any of the important fields
-            total_changed = compare_func(relevant_old.get('total'), relevant_new.get('total'))
-            coursework_changed = compare_func(relevant_old.get('coursework'), relevant_new.get('coursework'))
-            final_exam_changed = compare_func(relevant_old.get('final_exam'), relevant_new.get('final_exam'))
+            old_total, old_coursework, old_final_exam = relevant_old
+            new_total, new_coursework, new_final_exam = relevant_new
+            total_changed = compare_func(old_total, new_total)
+            coursework_changed = compare_func(old_coursework, new_coursework)
+            final_exam_changed = compare_func(old_final_exam, new_final_exam)
             
             has_changes = total_changed or coursework_changed or final_exam_changed
             
@@ -1128,12 +1366,12 @@ class TelegramBot:
             await update.message.reply_text(
                 "🚫 تم حظر محاولات تسجيل الدخول مؤقتاً بسبب كثرة المحاولات الفاشلة.\n"
                 "يرجى المحاولة مرة أخرى بعد 15 دقيقة.",
-                reply_markup=get_unregistered_keyboard()
+                reply_markup=self._kb_unregistered
             )
             return ConversationHandler.END
         
         # Clear previous session and user data
-        existing_user = self.user_storage.get_user(user_id)
+        existing_user = await self._get_user(user_id)
         if existing_user:
             logger.info(f"User {user_id} is relogging in. Clearing existing session.")
             # Invalidate session
@@ -1142,15 +1380,9 @@ class TelegramBot:
             # Clear user data from context
             context.user_data.clear()
             # Remove user token
-            if hasattr(self.user_storage, 'clear_user_token'):
-                # For PostgreSQL storage
-                self.user_storage.clear_user_token(user_id)
-            else:
-                # For file storage
-                existing_user["token"] = None
-                existing_user["token_expired_notified"] = False
-                if hasattr(self.user_storage, '_save_users'):
-                    self.user_storage._save_users()
+            self.university_api.forget_token(existing_user.get("session_token"))
+            await asyncio.to_thread(self.user_storage.clear_user_token, user_id)
+        context.user_data['_reg'] = RegistrationState(was_registered=existing_user is not None)
         
         # Show security info before asking for credentials
         await update.message.reply_text(get_credentials_security_info_message())
@@ -1172,14 +1404,14 @@ class TelegramBot:
             return ASK_USERNAME
         
         # Validate university code format
-        if not re.fullmatch(r"[A-Za-z]{3,}[0-9]{4,}", username):
+        if not _UNI_CODE_RE.fullmatch(username):
             await update.message.reply_text(
                 "❌ الكود الجامعي يجب أن يكون على الشكل: 3 أحرف أو أكثر ثم 4 أرقام أو أكثر (مثال: ENG2425041).\n\n"
                 "❌ University code must be in the form: 3+ letters then 4+ digits (e.g., ENG2425041)."
             )
             return ASK_USERNAME
         
-        context.user_data['username'] = username
+        _registration_state(context).username = username
         await update.message.reply_text("يرجى إدخال كلمة المرور:")
         await update.message.reply_text(
             "🔒 ملاحظة: كلمة المرور لا تُخزن نهائياً وتُستخدم فقط لتسجيل الدخول. بياناتك آمنة بالكامل.\n"
@@ -1190,14 +1422,15 @@ class TelegramBot:
         return ASK_PASSWORD
 
     async def _register_password(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        username = context.user_data.get('username')
+        reg = _registration_state(context)
+        username = reg.username
         password = update.message.text.strip()
         telegram_id = update.effective_user.id
         # Make sure username is set
         if not username:
             await update.message.reply_text(
                 "❌ حدث خطأ في البيانات. يرجى المحاولة مرة أخرى.",
-                reply_markup=get_unregistered_keyboard()
+                reply_markup=self._kb_unregistered
             )
             return ConversationHandler.END
         # Validate password
@@ -1208,18 +1441,15 @@ class TelegramBot:
             )
             return ASK_PASSWORD
         # Check for invalid password characters
-        if any(char in password for char in ['<', '>', '"', "'", '&', ';', '|', '`', '$', '(', ')', '{', '}']):
+        if _BAD_PASSWORD_CHARS_RE.search(password):
             await update.message.reply_text(
                 "❌ كلمة المرور تحتوي على رموز غير مسموحة.\n\n"
                 "❌ Password contains invalid characters."
             )
             return ASK_PASSWORD
         # Store password in context for later use
-        context.user_data['password'] = password
+        reg.password = password
         # Prompt for session type with detailed explanation
-        session_keyboard = ReplyKeyboardMarkup([
-            ["🔒 جلسة مؤقتة (لا يتم تخزين كلمة المرور)", "🔑 جلسة دائمة (تخزين كلمة المرور مشفر)"]
-        ], resize_keyboard=True, one_time_keyboard=True)
         await update.message.reply_text(
             "🔐 **خيارات الجلسة**\n\n"
             "يمكنك اختيار نوع الجلسة التي تناسبك بعد تسجيل الدخول:\n\n"
@@ -1234,68 +1464,70 @@ class TelegramBot:
             "- عند انتهاء الجلسة أو انتهاء صلاحية رمز الدخول، سيقوم البوت بتسجيل الدخول تلقائيًا دون الحاجة لإعادة إدخال كلمة المرور.\n"
             "- هذا الخيار مناسب إذا كنت تريد سهولة الاستخدام وعدم الحاجة لإدخال كلمة المرور كل مرة.\n\n"
             "\nيرجى اختيار أحد الخيارات من الأزرار أدناه:",
-            reply_markup=session_keyboard
+            reply_markup=_SESSION_TYPE_KEYBOARD
         )
         return ASK_SESSION_TYPE
 
     async def _register_session_type(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = update.message.text.strip()
-        if "مؤقتة" in text:
+        reg = _registration_state(context)
+        if text == BTN_TEMP:
             # Temporary session: do not store password
-            context.user_data['session_type'] = 'temporary'
-            context.user_data['password_stored'] = False
-            context.user_data['password_consent_given'] = False
+            reg.session_type = 'temporary'
+            reg.password_stored = False
+            reg.password_consent_given = False
             return await self._register_login_and_fetch_info(update, context)
-        elif "دائمة" in text:
+        elif text == BTN_PERM:
             # Permanent session: ask for password confirmation
-            context.user_data['session_type'] = 'permanent'
+            reg.session_type = 'permanent'
             await update.message.reply_text(
                 "يرجى إدخال كلمة المرور مرة أخرى للتأكيد (لن يتم عرضها لأي شخص):",
-                reply_markup=ReplyKeyboardMarkup([["❌ إلغاء"]], resize_keyboard=True, one_time_keyboard=True)
+                reply_markup=_CANCEL_KEYBOARD
             )
-            context.user_data['password_confirm_attempts'] = 0
+            reg.password_confirm_attempts = 0
             return ASK_PASSWORD_CONFIRM
         else:
             await update.message.reply_text(
                 "❌ يرجى اختيار أحد الخيارات من الأزرار فقط.",
-                reply_markup=ReplyKeyboardMarkup([
-                    ["🔒 جلسة مؤقتة (لا يتم تخزين كلمة المرور)", "🔑 جلسة دائمة (تخزين كلمة المرور مشفر)"]
-                ], resize_keyboard=True, one_time_keyboard=True)
+                reply_markup=_SESSION_TYPE_KEYBOARD
             )
             return ASK_SESSION_TYPE
 
     async def _register_password_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        password = context.user_data.get('password')
+        reg = _registration_state(context)
+        password = reg.password
         confirm = update.message.text.strip()
-        attempts = context.user_data.get('password_confirm_attempts', 0) + 1
-        context.user_data['password_confirm_attempts'] = attempts
-        if confirm != password:
+        reg.password_confirm_attempts += 1
+        attempts = reg.password_confirm_attempts
+        if not hmac.compare_digest(confirm.encode(), (password or "").encode()):
             if attempts >= 3:
                 await update.message.reply_text(
                     "❌ تم إدخال كلمة مرور خاطئة 3 مرات. سيتم التحويل إلى جلسة مؤقتة.",
-                    reply_markup=ReplyKeyboardMarkup([
-                        ["🔒 جلسة مؤقتة (لا يتم تخزين كلمة المرور)"]
-                    ], resize_keyboard=True, one_time_keyboard=True)
+                    reply_markup=_TEMP_SESSION_KEYBOARD
                 )
-                context.user_data['session_type'] = 'temporary'
-                context.user_data['password_stored'] = False
-                context.user_data['password_consent_given'] = False
-                return await self._register_login_and_fetch_info(update, context)
+                reg.session_type = 'temporary'
+                reg.password_stored = False
+                reg.password_consent_given = False
+                reg.password = None
+                return await self._register_login_and_fetch_info(update, context, password)
             else:
                 await update.message.reply_text(
                     f"❌ كلمة المرور غير متطابقة. حاول مرة أخرى. (محاولة {attempts}/3)",
-                    reply_markup=ReplyKeyboardMarkup([["❌ إلغاء"]], resize_keyboard=True, one_time_keyboard=True)
+                    reply_markup=_CANCEL_KEYBOARD
                 )
                 return ASK_PASSWORD_CONFIRM
         # Passwords match, proceed
-        context.user_data['password_stored'] = True
-        context.user_data['password_consent_given'] = True
-        return await self._register_login_and_fetch_info(update, context)
-
-    async def _register_login_and_fetch_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        username = context.user_data.get('username')
-        password = context.user_data.get('password')
-        session_type = context.user_data.get('session_type', 'temporary')
+        del confirm
+        reg.password_stored = True
+        reg.password_consent_given = True
+        reg.password = None
+        return await self._register_login_and_fetch_info(update, context, password)
+
+    async def _register_login_and_fetch_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE, password=None):
+        reg = _registration_state(context)
+        username = reg.username
+        if password is None:
+            password, reg.password = reg.password, None
         telegram_id = update.effective_user.id
         # Try to log in with university API
         await update.message.reply_text("🔄 جاري التحقق من بياناتك...\nChecking your credentials...")
@@ -1303,231 +1535,266 @@ class TelegramBot:
         # Record login attempt
         success = token is not None
         security_manager.record_login_attempt(telegram_id, success, username)
+        # Only permanent sessions keep the plaintext, and only until it is encrypted
+        if not reg.password_stored:
+            password = None
         if not token:
             await update.message.reply_text(
                 "❌ تعذّر تسجيل الدخول. يرجى التأكد من صحة اسم المستخدم وكلمة المرور الجامعية وإعادة المحاولة.\n\nLogin failed. Please check your university username and password and try again.",
-                reply_markup=get_unregistered_keyboard()
+                reply_markup=self._kb_unregistered
             )
             return await self._register_start(update, context)
         # Get user info for welcome message
         user_info = await self.university_api.get_user_info(token)
         if user_info:
-            api_fullname = user_info.get('fullname', '')
-            api_firstname = user_info.get('firstname', '')
-            api_lastname = user_info.get('lastname', '')
+            api_fullname = (user_info.get('fullname') or '').strip()
+            api_firstname = (user_info.get('firstname') or '').strip()
+            api_lastname = (user_info.get('lastname') or '').strip()
             api_username = user_info.get('username', username)
-            email = user_info.get('email', '-')
-            if api_fullname and api_fullname.strip():
-                fullname = api_fullname.strip()
-                if api_firstname and api_firstname.strip():
-                    firstname = api_firstname.strip()
-                    lastname = api_lastname.strip() if api_lastname else ''
+            email = user_info.get('email') or '-'
+            if api_fullname:
+                fullname = api_fullname
+                if api_firstname:
+                    firstname, lastname = api_firstname, api_lastname
                 else:
-                    name_parts = fullname.split()
-                    if len(name_parts) >= 2:
-                        firstname = name_parts[0]
-                        lastname = ' '.join(name_parts[1:])
-                    else:
-                        firstname = fullname
-                        lastname = ''
+                    firstname, _, rest = api_fullname.partition(' ')
+                    lastname = rest.strip()
             else:
                 fullname = f"طالب جامعة الشام ({api_username})"
-                firstname = "طالب"
-                lastname = "جامعة الشام"
+                firstname, lastname = "طالب", "جامعة الشام"
         else:
             fullname = f"طالب جامعة الشام ({username})"
             firstname = "طالب"
             lastname = "جامعة الشام"
             email = '-'
-        context.user_data['user_data'] = {
+        reg.user_data = {
             "username": username,
             "fullname": fullname,
             "firstname": firstname,
             "lastname": lastname,
             "email": email
         }
-        context.user_data['token'] = token
-        return await self._complete_registration(update, context)
+        reg.token = token
+        return await self._complete_registration(update, context, password)
 
-    async def _complete_registration(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def _complete_registration(self, update: Update, context: ContextTypes.DEFAULT_TYPE, password=None):
         telegram_id = update.effective_user.id
-        user_data = context.user_data.get('user_data')
-        token = context.user_data.get('token')
-        password = context.user_data.get('password')
-        password_stored = context.user_data.get('password_stored', False)
-        password_consent_given = context.user_data.get('password_consent_given', False)
-        session_type = context.user_data.get('session_type', 'temporary')
+        reg = context.user_data.pop('_reg', None) or RegistrationState()
+        user_data = reg.user_data
+        token = reg.token
+        password_stored = reg.password_stored
+        password_consent_given = reg.password_consent_given
+        session_type = reg.session_type
         if not user_data or not token:
             await update.message.reply_text(
                 "❌ حدث خطأ في البيانات. يرجى المحاولة مرة أخرى.",
-                reply_markup=get_unregistered_keyboard()
+                reply_markup=self._kb_unregistered
             )
             return ConversationHandler.END
         # Encrypt password if permanent session
         encrypted_password = None
         if password_stored and password:
-            from utils.crypto import encrypt_password
             try:
-                encrypted_password = encrypt_password(password)
+                encrypted_password = await asyncio.to_thread(encrypt_password, password)
                 logger.info("✅ Password encrypted successfully")
             except Exception as e:
                 logger.error(f"❌ Error encrypting password: {e}")
                 logger.info("🔄 Continuing with temporary session due to encryption failure")
                 await update.message.reply_text(
                     "⚠️ حدث خطأ أثناء تشفير كلمة المرور. سيتم المتابعة بجلسة مؤقتة.",
-                    reply_markup=get_unregistered_keyboard()
+                    reply_markup=self._kb_unregistered
                 )
                 password_stored = False
                 password_consent_given = False
-        # Save user to database
-        try:
-            user_dict = {
-                "telegram_id": telegram_id,
-                "username": user_data['username'],
-                "fullname": user_data.get('fullname'),
-                "firstname": user_data.get('firstname'),
-                "lastname": user_data.get('lastname'),
-                "email": user_data.get('email'),
-                "session_token": token,
-                "token_expires_at": None,  # Set if you have it
-                "is_active": True,
-                # Optionally add encrypted_password, password_stored, password_consent_given if your User model supports them
-            }
-            success = self.user_storage.create_user(user_dict)
-            if not success:
-                # User exists, update their info
-                self.user_storage.update_user(user_data['username'], {
-                    "session_token": token,
-                    "token_expires_at": None,
-                    "is_active": True,
-                    "fullname": user_data.get('fullname'),
-                    "firstname": user_data.get('firstname'),
-                    "lastname": user_data.get('lastname'),
-                    "email": user_data.get('email'),
-                    "encrypted_password": encrypted_password,
-                    "password_stored": password_stored,
-                    "password_consent_given": password_consent_given
-                })
-                logger.warning(f"User {user_data['username']} already exists, updated session info.")
-                welcome_message = get_welcome_message(user_data['fullname'])
-                if session_type == 'permanent' and password_stored:
-                    welcome_message += "\n\n🔑 **جلسة دائمة**\nكلمة المرور مخزنة بشكل مشفر. سيتم تسجيل الدخول تلقائياً عند انتهاء الجلسة."
-                else:
-                    welcome_message += "\n\n🔐 **جلسة مؤقتة**\nكلمة المرور لم تُخزن. ستحتاج لتسجيل الدخول مرة أخرى عند انتهاء الجلسة."
-                try:
-                    await update.message.reply_text(welcome_message, reply_markup=get_main_keyboard())
-                except Exception as e:
-                    logger.error(f"Error sending welcome message: {e}")
-                    await update.message.reply_text(welcome_message)
-                return ConversationHandler.END
-            logger.info(f"✅ User saved successfully")
-        except Exception as e:
-            logger.error(f"❌ Error saving user: {e}", exc_info=True)
+        password = None
+        # Save user to database (insert or refresh in a single statement)
+        user_dict = {
+            "telegram_id": telegram_id,
+            "username": user_data['username'],
+            "fullname": user_data.get('fullname'),
+            "firstname": user_data.get('firstname'),
+            "lastname": user_data.get('lastname'),
+            "email": user_data.get('email'),
+            "session_token": token,
+            "token_expires_at": None,  # Set if you have it
+            "encrypted_password": encrypted_password,
+            "password_stored": password_stored,
+            "password_consent_given": password_consent_given,
+        }
+        inserted = await asyncio.to_thread(self.user_storage.upsert_user, user_dict)
+        if inserted is None:
             await update.message.reply_text(
                 "❌ حدث خطأ أثناء حفظ البيانات. يرجى المحاولة مرة أخرى.",
-                reply_markup=get_unregistered_keyboard()
+                reply_markup=self._kb_unregistered
             )
             return ConversationHandler.END
+        if not inserted:
+            logger.warning(f"User {user_data['username']} already exists, updated session info.")
         # Create session
         try:
             security_manager.create_user_session(telegram_id, token, user_data)
             logger.info(f"✅ User session created successfully")
         except Exception as e:
             logger.error(f"❌ Error creating user session: {e}", exc_info=True)
-        # Show welcome message
-        welcome_message = get_welcome_message(user_data['fullname'])
-        if session_type == 'permanent' and password_stored:
-            welcome_message += "\n\n🔑 **جلسة دائمة**\nكلمة المرور مخزنة بشكل مشفر. سيتم تسجيل الدخول تلقائياً عند انتهاء الجلسة."
-        else:
-            welcome_message += "\n\n🔐 **جلسة مؤقتة**\nكلمة المرور لم تُخزن. ستحتاج لتسجيل الدخول مرة أخرى عند انتهاء الجلسة."
+        await self._send_welcome(update, user_data['fullname'], session_type, password_stored)
+        return ConversationHandler.END
+
+    async def _send_welcome(self, update: Update, fullname, session_type, password_stored):
+        """Send the post-registration welcome message for the chosen session type"""
+        suffix = WELCOME_SUFFIX_PERMANENT if (session_type == 'permanent' and password_stored) else WELCOME_SUFFIX_TEMPORARY
+        welcome_message = get_welcome_message(fullname) + suffix
         try:
-            await update.message.reply_text(welcome_message, reply_markup=get_main_keyboard())
+            await update.message.reply_text(welcome_message, reply_markup=self._kb_main)
         except Exception as e:
             logger.error(f"Error sending welcome message: {e}")
             await update.message.reply_text(welcome_message)
-        return ConversationHandler.END
+
+    async def _session_button_outside_registration(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """A session-type button pressed outside registration: show the welcome message and keyboard"""
+        user = await self._get_user(update.effective_user.id)
+        if user:
+            await update.message.reply_text(get_welcome_message(user.get('fullname')), reply_markup=self._kb_main)
+        else:
+            await update.message.reply_text(get_simple_welcome_message(), reply_markup=self._kb_unregistered)
 
     async def _return_to_main(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Return to main keyboard from admin interface"""
-        keyboard_to_show = get_main_keyboard() if self.user_storage.is_user_registered(update.effective_user.id) else get_unregistered_keyboard()
+        keyboard_to_show = self._kb_main if await self._is_registered(update.effective_user.id) else self._kb_unregistered
         await update.message.reply_text(
             "تمت العودة إلى القائمة الرئيسية.",
             reply_markup=keyboard_to_show
         )
 
     async def _cancel_registration(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        is_registered = self.user_storage.is_user_registered(update.effective_user.id)
-        keyboard = get_main_keyboard() if is_registered else get_unregistered_keyboard()
+        reg = context.user_data.pop('_reg', None)
+        if reg is not None:
+            is_registered = reg.was_registered
+        else:
+            is_registered = await self._is_registered(update.effective_user.id)
+        keyboard = self._kb_main if is_registered else self._kb_unregistered
         await update.message.reply_text("تم إلغاء التسجيل.", reply_markup=keyboard)
         return ConversationHandler.END
 
     async def send_quote_to_all_users(self, message, parse_mode=None):
-        users = self.user_storage.get_all_users()
+        sent, failures = await self._broadcast(message, parse_mode=parse_mode)
+        return sent, sum(failures.values())
+
+    async def _broadcast(self, text, parse_mode=None, users=None):
+        """Send a message to all active users (or the given users), paced to Telegram's rate limit.
+
+        Returns (sent, failures), where failures counts failed chats per reason
+        ("blocked", "invalid" or "other").
+        """
+        if users is None:
+            users = await asyncio.to_thread(self.user_storage.get_all_users)
+        chat_ids = [user['telegram_id'] for user in users if user.get('telegram_id')]
+        loop = asyncio.get_running_loop()
         sent = 0
-        for user in users:
+        failures = Counter()
+        for start in range(0, len(chat_ids), BROADCAST_MESSAGES_PER_SECOND):
+            batch_started = loop.time()
+            batch = chat_ids[start:start + BROADCAST_MESSAGES_PER_SECOND]
+            results = await asyncio.gather(*(self._send_broadcast_message(chat_id, text, parse_mode) for chat_id in batch))
+            for reason in results:
+                if reason is None:
+                    sent += 1
+                else:
+                    failures[reason] += 1
+            elapsed = loop.time() - batch_started
+            if start + BROADCAST_MESSAGES_PER_SECOND < len(chat_ids) and elapsed < 1:
+                await asyncio.sleep(1 - elapsed)
+        failed = sum(failures.values())
+        logger.info(f"Broadcast summary: sent={sent}, failed={failed}, total={len(chat_ids)}")
+        if failed:
+            logger.info(
+                f"Failure breakdown: blocked={failures['blocked']}, invalid={failures['invalid']}, other={failures['other']}"
+            )
+        return sent, failures
+
+    async def _send_broadcast_message(self, chat_id, text, parse_mode=None) -> Optional[str]:
+        """Send one broadcast message, waiting out a single flood-control RetryAfter.
+
+        Returns None once sent, otherwise the failure reason: "blocked" (the user
+        blocked the bot), "invalid" (Telegram rejected the chat) or "other".
+        """
+        for attempt in range(2):
             try:
-                await self.app.bot.send_message(
-                    chat_id=user['telegram_id'], 
-                    text=message,
-                    parse_mode=parse_mode
-                )
-                sent += 1
+                await self.app.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                return None
+            except RetryAfter as e:
+                if attempt:
+                    break
+                logger.warning(f"Flood control hit while broadcasting, retrying {chat_id} in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except Forbidden:
+                logger.warning(f"User {chat_id} blocked the bot")
+                return "blocked"
+            except BadRequest as e:
+                logger.warning(f"Invalid chat {chat_id}: {e}")
+                return "invalid"
             except Exception as e:
-                logger.warning(f"Failed to send message to {user.get('telegram_id')}: {e}")
-                continue
-        return sent
+                logger.warning(f"Failed to send message to {chat_id}: {e}")
+                return "other"
+        return "other"
+
+    async def _send_quote_to_users(self, quote):
+        """Broadcast a quote page by page, formatting it once per translation preference"""
+        quote_texts = {}
+        sent = 0
+        after = None
+        while True:
+            page = await asyncio.to_thread(
+                self.user_storage.get_broadcast_targets_page, after, QUOTE_BROADCAST_PAGE_SIZE
+            )
+            if not page:
+                return sent
+            after = page[-1][0]
+            groups = {}
+            for _, telegram_id, do_trans in page:
+                groups.setdefault(bool(do_trans), []).append({"telegram_id": telegram_id})
+            for do_translate, users in groups.items():
+                if do_translate not in quote_texts:
+                    # HTML escapes the quote itself; legacy Markdown failed on any _, *, ` or [ in it
+                    quote_texts[do_translate] = await self.grade_analytics.format_quote_dual_language(
+                        quote, do_translate=do_translate, html=True
+                    )
+                quote_text = quote_texts[do_translate]
+                if quote_text.strip():  # Only send if there's content
+                    group_sent, _ = await self._broadcast(quote_text, parse_mode=ParseMode.HTML, users=users)
+                    sent += group_sent
+            if len(page) < QUOTE_BROADCAST_PAGE_SIZE:
+                return sent
 
     async def scheduled_daily_quote_broadcast(self):
         """Send daily quote to all users at scheduled time"""
-        import pytz
-        from datetime import datetime, time, timedelta
-        tz = pytz.timezone('Asia/Riyadh')
-        # Get schedule from environment
-        def get_scheduled_time():
-            time_str = os.getenv("QUOTE_SCHEDULE", "14:00")
-            try:
-                hour, minute = map(int, time_str.strip().split(":"))
-                if 0 <= hour < 24 and 0 <= minute < 60:
-                    return hour, minute
-            except Exception:
-                pass
-            return 14, 0  # default time
-        target_hour, target_minute = get_scheduled_time()
+        target_hour, target_minute = _parse_quote_schedule(os.getenv("QUOTE_SCHEDULE", "14:00"))
         logger.info(f"🕑 Daily quote scheduler started (UTC+3) at {target_hour:02d}:{target_minute:02d}")
+        now = datetime.now(_TZ)
+        next_run = now.replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
+        if now >= next_run:
+            next_run += timedelta(days=1)
         while self.running:
-            now = datetime.now(tz)
-            next_run = now.replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
-            if now >= next_run:
+            # Re-read the wall clock each cycle so oversleeping (e.g. a suspended host)
+            # skips missed days instead of firing a burst of catch-up broadcasts
+            now = datetime.now(_TZ)
+            while next_run <= now - timedelta(minutes=1):
                 next_run += timedelta(days=1)
-            wait_seconds = (next_run - now).total_seconds()
+            wait_seconds = max((next_run - now).total_seconds(), 0)
             logger.info(f"Next daily quote broadcast in {wait_seconds/60:.1f} minutes")
             await asyncio.sleep(wait_seconds)
+            next_run += timedelta(days=1)
             if not self.running:
                 break
-            # Fetch and send the quote
-            quote = await self.grade_analytics.get_daily_quote()
-            if quote:
-                # Send quote to each user with their individual translation preference
-                sent_count = 0
-                for user in self.user_storage.get_all_users():
-                    telegram_id = user.get("telegram_id")
-                    if telegram_id:
-                        try:
-                            # Get user's translation preference
-                            do_translate = user.get("do_trans", False)
-                            quote_text = await self.grade_analytics.format_quote_dual_language(quote, do_translate=do_translate)
-                            if quote_text.strip():  # Only send if there's content
-                                await self.app.bot.send_message(
-                                    chat_id=telegram_id, 
-                                    text=quote_text, 
-                                    parse_mode=ParseMode.MARKDOWN
-                                )
-                                sent_count += 1
-                        except Exception as e:
-                            logger.warning(f"Failed to send scheduled quote to {telegram_id}: {e}")
-                logger.info(f"✅ تم إرسال رسالة اليوم إلى {sent_count} مستخدم.")
-            else:
-                logger.warning("No quote available for scheduled broadcast.")
+            await self._run_background_job("daily quote", self._send_daily_quote)
+
+    async def _send_daily_quote(self):
+        # Fetch and send the quote
+        quote = await self.grade_analytics.get_daily_quote()
+        if quote:
+            sent_count = await self._send_quote_to_users(quote)
+            logger.info(f"✅ تم إرسال رسالة اليوم إلى {sent_count} مستخدم.")
+        else:
+            logger.warning("No quote available for scheduled broadcast.")
 
     async def _how_it_works_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
@@ -1545,45 +1812,41 @@ class TelegramBot:
             if not quote:
                 logger.warning("No quote available for broadcast.")
                 return
-            # Send quote to each user with their individual translation preference
-            for user in self.user_storage.get_all_users():
-                telegram_id = user.get("telegram_id")
-                if telegram_id:
-                    try:
-                        # Get user's translation preference
-                        do_translate = user.get("do_trans", False)
-                        quote_text = await self.grade_analytics.format_quote_dual_language(quote, do_translate=do_translate)
-                        if quote_text.strip():  # Only send if there's content
-                            await context.bot.send_message(chat_id=telegram_id, text=quote_text, parse_mode=ParseMode.MARKDOWN)
-                    except Exception as e:
-                        logger.warning(f"Failed to send quote to {telegram_id}: {e}")
+            await self._send_quote_to_users(quote)
         except Exception as e:
             logger.error(f"Error in _broadcast_quote: {e}")
 
     async def _refresh_keyboard(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Refresh keyboard based on user registration status"""
         try:
-            user = self.user_storage.get_user(update.effective_user.id)
+            user = await self._get_user(update.effective_user.id)
             if user:
                 await update.message.reply_text(
                     "✅ تم تحديث الأزرار للمستخدمين المسجلين.",
-                    reply_markup=get_main_keyboard()
+                    reply_markup=self._kb_main
                 )
             else:
                 await update.message.reply_text(
                     "❌ أنت غير مسجل. يرجى التسجيل أولاً.",
-                    reply_markup=get_unregistered_keyboard()
+                    reply_markup=self._kb_unregistered
                 )
         except Exception as e:
             logger.error(f"[ALERT] Error in _refresh_keyboard: {e}", exc_info=True)
-            admin_id = CONFIG.get("ADMIN_ID")
-            admin_username = CONFIG.get("ADMIN_USERNAME", "@admin")
+            admin_id = self._admin_id
+            admin_username = ADMIN_USERNAME
             if admin_id:
                 try:
                     await self.app.bot.send_message(chat_id=admin_id, text=f"[REFRESH ERROR] User: {getattr(update.effective_user, 'id', None)}\nError: {e}")
                 except Exception:
                     pass
-            await update.message.reply_text(f"❌ حدث خطأ أثناء تحديث الأزرار. إذا استمرت المشكلة، لا تتردد في التواصل مع المطور {admin_username}.", reply_markup=get_main_keyboard())
+            await update.message.reply_text(f"❌ حدث خطأ أثناء تحديث الأزرار. إذا استمرت المشكلة، لا تتردد في التواصل مع المطور {admin_username}.", reply_markup=self._kb_main)
+
+    async def _clear_user_token(self, telegram_id: int):
+        """Log the user out in storage and stop trusting their token in the API client"""
+        user = await self._get_user(telegram_id)
+        if user:
+            self.university_api.forget_token(user.get("session_token"))
+        await asyncio.to_thread(self.user_storage.clear_user_token, telegram_id)
 
     async def _force_logout_user(self, telegram_id: int, update: Update):
         """Force logout user due to invalid token"""
@@ -1594,22 +1857,12 @@ class TelegramBot:
             security_manager.session_manager.invalidate_session(telegram_id)
         
         # Clear user token
-        if hasattr(self.user_storage, 'clear_user_token'):
-            # For PostgreSQL storage
-            self.user_storage.clear_user_token(telegram_id)
-        else:
-            # For file storage
-            user = self.user_storage.get_user(telegram_id)
-            if user:
-                user["token"] = None
-                user["is_active"] = False
-                if hasattr(self.user_storage, '_save_users'):
-                    self.user_storage._save_users()
+        await self._clear_user_token(telegram_id)
         
         # Notify user
         await update.message.reply_text(
             "⏰ انتهت صلاحية الجلسة\n\nتم تسجيل الخروج تلقائياً لحماية حسابك. يرجى تسجيل الدخول مرة أخرى من خلال زر '🚀 تسجيل الدخول للجامعة'.",
-            reply_markup=get_unregistered_keyboard()
+            reply_markup=self._kb_unregistered
         )
 
     async def _logout_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1618,153 +1871,138 @@ class TelegramBot:
         if hasattr(security_manager, 'session_manager'):
             security_manager.session_manager.invalidate_session(telegram_id)
         # Remove user token and mark as inactive
-        user = self.user_storage.get_user(telegram_id)
-        if user:
-            if hasattr(self.user_storage, 'clear_user_token'):
-                # For PostgreSQL storage
-                self.user_storage.clear_user_token(telegram_id)
-            else:
-                # For file storage
-                user["token"] = None
-                user["is_active"] = False
-                if hasattr(self.user_storage, '_save_users'):
-                    self.user_storage._save_users()
+        await self._clear_user_token(telegram_id)
         await update.message.reply_text(
             "✅ تم تسجيل الخروج بنجاح. يمكنك تسجيل الدخول مرة أخرى في أي وقت.",
-            reply_markup=get_unregistered_keyboard()
+            reply_markup=self._kb_unregistered
         )
 
     async def _settings_callback_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
-        user_id = update.effective_user.id
-        user = self.user_storage.get_user_by_telegram_id(user_id)
+        user = await self._get_user(update.effective_user.id)
+        handler = self._settings_callbacks.get(query.data, self._cb_unknown)
+        await handler(update, query, user)
 
-        if query.data == "delete_user_data":
-            if not user:
-                await query.edit_message_text("❗️ يجب التسجيل أولاً.")
-                return
-            # Show confirmation for data deletion
-            await query.edit_message_text(
-                "🗑️ **حذف البيانات الشخصية**\n\n"
-                "⚠️ **تحذير**: هذا الإجراء سيحذف:\n"
-                "• جميع بياناتك المخزنة\n"
-                "• كلمة المرور المشفرة\n"
-                "• إعداداتك الشخصية\n"
-                "• سجل الدرجات\n\n"
-                "❌ **لا يمكن التراجع عن هذا الإجراء**\n\n"
-                "هل أنت متأكد من حذف جميع بياناتك؟",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ نعم، احذف جميع بياناتي", callback_data="confirm_delete_data")],
-                    [InlineKeyboardButton("❌ إلغاء", callback_data="cancel_delete_data")]
-                ])
-            )
-            return
-            
-        elif query.data == "confirm_delete_data":
-            if not user:
-                await query.edit_message_text("❗️ يجب التسجيل أولاً.")
-                return
-            # Delete user data
-            try:
-                # Delete user from storage
-                self.user_storage.delete_user(user["username"])
-                # Delete grades
-                self.grade_storage.delete_user_grades(user["username"])
-                await query.edit_message_text(
-                    "✅ تم حذف جميع بياناتك بنجاح.\n\n"
-                    "تم تسجيل خروجك تلقائياً. يمكنك التسجيل مرة أخرى إذا أردت.",
-                    reply_markup=get_unregistered_keyboard()
-                )
-            except Exception as e:
-                await query.edit_message_text(
-                    f"❌ حدث خطأ أثناء حذف البيانات: {str(e)}\n\n"
-                    "يرجى المحاولة مرة أخرى أو التواصل مع الدعم الفني."
-                )
+    async def _cb_delete_user_data(self, update: Update, query, user):
+        if not user:
+            await query.edit_message_text("❗️ يجب التسجيل أولاً.")
             return
-            
-        elif query.data == "cancel_delete_data":
-            # Return to privacy settings
-            await query.edit_message_text(
-                "تم إلغاء حذف البيانات.",
-                reply_markup=get_privacy_settings_keyboard()
-            )
+        # Show confirmation for data deletion
+        await query.edit_message_text(
+            "🗑️ **حذف البيانات الشخصية**\n\n"
+            "⚠️ **تحذير**: هذا الإجراء سيحذف:\n"
+            "• جميع بياناتك المخزنة\n"
+            "• كلمة المرور المشفرة\n"
+            "• إعداداتك الشخصية\n"
+            "• سجل الدرجات\n\n"
+            "❌ **لا يمكن التراجع عن هذا الإجراء**\n\n"
+            "هل أنت متأكد من حذف جميع بياناتك؟",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ نعم، احذف جميع بياناتي", callback_data="confirm_delete_data")],
+                [InlineKeyboardButton("❌ إلغاء", callback_data="cancel_delete_data")]
+            ])
+        )
+
+    async def _cb_confirm_delete_data(self, update: Update, query, user):
+        if not user:
+            await query.edit_message_text("❗️ يجب التسجيل أولاً.")
             return
-            
-        elif query.data == "toggle_show_profile":
-            if not user:
-                await query.edit_message_text("❗️ يجب التسجيل أولاً.")
-                return
-            # Toggle profile visibility (placeholder for future implementation)
+        # Delete user data
+        try:
+            # Delete user from storage
+            await asyncio.to_thread(self.user_storage.delete_user, user["username"])
+            # Delete grades
+            await asyncio.to_thread(self.grade_storage.delete_user_grades, user["username"])
             await query.edit_message_text(
-                "👁️ **عرض المعلومات الشخصية**\n\n"
-                "هذه الميزة قيد التطوير.\n\n"
-                "ستتمكن قريباً من التحكم في عرض معلوماتك الشخصية للآخرين.",
-                reply_markup=get_privacy_settings_keyboard()
+                "✅ تم حذف جميع بياناتك بنجاح.\n\n"
+                "تم تسجيل خروجك تلقائياً. يمكنك التسجيل مرة أخرى إذا أردت.",
+                reply_markup=self._kb_unregistered
             )
-            return
-            
-        elif query.data == "toggle_share_stats":
-            if not user:
-                await query.edit_message_text("❗️ يجب التسجيل أولاً.")
-                return
-            # Toggle stats sharing (placeholder for future implementation)
+        except Exception as e:
             await query.edit_message_text(
-                "📊 **مشاركة الإحصائيات**\n\n"
-                "هذه الميزة قيد التطوير.\n\n"
-                "ستتمكن قريباً من التحكم في مشاركة إحصائياتك مع المطورين لتحسين الخدمة.",
-                reply_markup=get_privacy_settings_keyboard()
+                f"❌ حدث خطأ أثناء حذف البيانات: {str(e)}\n\n"
+                "يرجى المحاولة مرة أخرى أو التواصل مع الدعم الفني."
             )
+
+    async def _cb_cancel_delete_data(self, update: Update, query, user):
+        # Return to privacy settings
+        await query.edit_message_text(
+            "تم إلغاء حذف البيانات.",
+            reply_markup=get_privacy_settings_keyboard()
+        )
+
+    async def _cb_toggle_show_profile(self, update: Update, query, user):
+        if not user:
+            await query.edit_message_text("❗️ يجب التسجيل أولاً.")
             return
-            
-        elif query.data == "data_retention":
-            if not user:
-                await query.edit_message_text("❗️ يجب التسجيل أولاً.")
-                return
-            # Data retention settings (placeholder for future implementation)
-            await query.edit_message_text(
-                "📅 **فترة الاحتفاظ بالبيانات**\n\n"
-                "هذه الميزة قيد التطوير.\n\n"
-                "ستتمكن قريباً من تحديد المدة التي نحتفظ فيها ببياناتك.",
-                reply_markup=get_privacy_settings_keyboard()
-            )
+        # Toggle profile visibility (placeholder for future implementation)
+        await query.edit_message_text(
+            "👁️ **عرض المعلومات الشخصية**\n\n"
+            "هذه الميزة قيد التطوير.\n\n"
+            "ستتمكن قريباً من التحكم في عرض معلوماتك الشخصية للآخرين.",
+            reply_markup=get_privacy_settings_keyboard()
+        )
+
+    async def _cb_toggle_share_stats(self, update: Update, query, user):
+        if not user:
+            await query.edit_message_text("❗️ يجب التسجيل أولاً.")
             return
-            
-        elif query.data == "back_to_settings":
-            # Return to main settings
-            from utils.keyboards import get_settings_main_keyboard
-            keyboard = get_settings_main_keyboard()
-            await query.edit_message_text(
-                "تمت العودة إلى الإعدادات الرئيسية.",
-                reply_markup=keyboard
-            )
+        # Toggle stats sharing (placeholder for future implementation)
+        await query.edit_message_text(
+            "📊 **مشاركة الإحصائيات**\n\n"
+            "هذه الميزة قيد التطوير.\n\n"
+            "ستتمكن قريباً من التحكم في مشاركة إحصائياتك مع المطورين لتحسين الخدمة.",
+            reply_markup=get_privacy_settings_keyboard()
+        )
+
+    async def _cb_data_retention(self, update: Update, query, user):
+        if not user:
+            await query.edit_message_text("❗️ يجب التسجيل أولاً.")
             return
-            
-        elif query.data == "back_to_main":
-            await query.edit_message_text(
-                "تمت العودة إلى القائمة الرئيسية.\n\n"
-                "نحن نقدر ثقتك ونسعى دائماً للشفافية في كل ما يتعلق ببياناتك."
-            )
-        elif query.data == "cancel_action":
-            is_registered = self.user_storage.is_user_registered(update.effective_user.id)
-            keyboard = get_main_keyboard() if is_registered else get_unregistered_keyboard()
-            await query.edit_message_text(
-                "✅ تم إلغاء العملية. يمكنك البدء من جديد أو اختيار إجراء آخر.",
-            )
-            await update.effective_chat.send_message(
-                "تمت إعادتك للقائمة الرئيسية.",
-                reply_markup=keyboard
-            )
+        # Data retention settings (placeholder for future implementation)
+        await query.edit_message_text(
+            "📅 **فترة الاحتفاظ بالبيانات**\n\n"
+            "هذه الميزة قيد التطوير.\n\n"
+            "ستتمكن قريباً من تحديد المدة التي نحتفظ فيها ببياناتك.",
+            reply_markup=get_privacy_settings_keyboard()
+        )
+
+    async def _cb_back_to_settings(self, update: Update, query, user):
+        # Return to main settings
+        await query.edit_message_text(
+            "تمت العودة إلى الإعدادات الرئيسية.",
+            reply_markup=get_settings_main_keyboard()
+        )
+
+    async def _cb_back_to_main(self, update: Update, query, user):
+        await query.edit_message_text(
+            "تمت العودة إلى القائمة الرئيسية.\n\n"
+            "نحن نقدر ثقتك ونسعى دائماً للشفافية في كل ما يتعلق ببياناتك."
+        )
+
+    async def _cb_cancel_action(self, update: Update, query, user):
+        keyboard = self._kb_main if user else self._kb_unregistered
+        await query.edit_message_text(
+            "✅ تم إلغاء العملية. يمكنك البدء من جديد أو اختيار إجراء آخر.",
+        )
+        await update.effective_chat.send_message(
+            "تمت إعادتك للقائمة الرئيسية.",
+            reply_markup=keyboard
+        )
+
+    async def _cb_unknown(self, update: Update, query, user):
+        logger.debug(f"Unhandled callback data: {query.data}")
 
     async def _gpa_calc_fallback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("تم إلغاء العملية. أرسل /start للبدء من جديد.")
         return ConversationHandler.END
 
     async def _gpa_calc_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        context.user_data['gpa_calc'] = {'courses': [], 'current': 0, 'count': 0}
+        context.user_data['gpa_calc'] = GpaState()
         await update.message.reply_text(
             "كم عدد المقررات التي تريد حساب المعدل التراكمي لها؟ (أدخل رقماً بين 1 و10)",
-            reply_markup=ReplyKeyboardMarkup([["❌ إلغاء"]], resize_keyboard=True, one_time_keyboard=True)
+            reply_markup=_CANCEL_KEYBOARD
         )
         return ASK_GPA_COURSE_COUNT
 
@@ -1773,11 +2011,12 @@ class TelegramBot:
             count = int(update.message.text.strip())
             if not (1 <= count <= 10):
                 raise ValueError
-            context.user_data['gpa_calc']['count'] = count
-            context.user_data['gpa_calc']['current'] = 1
+            state = _gpa_state(context)
+            state.count = count
+            state.current = 1
             await update.message.reply_text(
                 f"أدخل النسبة المئوية للمقرر رقم 1 (مثال: 85)",
-                reply_markup=ReplyKeyboardMarkup([["❌ إلغاء"]], resize_keyboard=True, one_time_keyboard=True)
+                reply_markup=_CANCEL_KEYBOARD
             )
             return ASK_GPA_PERCENTAGE
         except Exception:
@@ -1788,23 +2027,19 @@ class TelegramBot:
         try:
             # Try to extract integer from input
             text = update.message.text.strip()
-            # Extract first number (integer or float) from the string
-            import re
-            match = re.search(r"\d+(?:\.\d+)?", text)
-            if not match:
-                raise ValueError("No digits found")
-            percent = int(float(match.group(0)))
+            percent = _parse_percentage(text)
             if not (0 <= percent <= 100):
                 raise ValueError("Out of range")
             # Check if percentage is below 30 (0 earned points)
             if percent < 30:
                 await update.message.reply_text(f"⚠️ النسبة المئوية {percent}% أقل من 30%، ستكون النقاط المكتسبة 0.")
-            context.user_data['gpa_calc']['courses'].append({'percentage': percent})
+            state = _gpa_state(context)
+            state.courses.append(GpaCourse(percent))
             # Ask for ECTS for this course
-            current = context.user_data['gpa_calc']['current']
+            current = state.current
             await update.message.reply_text(
                 f"أدخل عدد نقاط ECTS المخصصة للمقرر رقم {current} (مثال: 4)",
-                reply_markup=ReplyKeyboardMarkup([["❌ إلغاء"]], resize_keyboard=True, one_time_keyboard=True)
+                reply_markup=_CANCEL_KEYBOARD
             )
             return ASK_GPA_ECTS
         except Exception:
@@ -1816,16 +2051,17 @@ class TelegramBot:
             ects = float(update.message.text.strip())
             if not (0.5 <= ects <= 20):
                 raise ValueError
-            current = context.user_data['gpa_calc']['current']
-            context.user_data['gpa_calc']['courses'][-1]['ects'] = ects
-            if current >= context.user_data['gpa_calc']['count']:
+            state = _gpa_state(context)
+            current = state.current
+            state.courses[-1].ects = ects
+            if current >= state.count:
                 # Calculate GPA
                 return await self._gpa_calc_show_result(update, context)
             else:
-                context.user_data['gpa_calc']['current'] += 1
+                state.current += 1
                 await update.message.reply_text(
-                    f"أدخل النسبة المئوية للمقرر رقم {context.user_data['gpa_calc']['current']} (دون إشارة %، مثال: 85)",
-                    reply_markup=ReplyKeyboardMarkup([["❌ إلغاء"]], resize_keyboard=True, one_time_keyboard=True)
+                    f"أدخل النسبة المئوية للمقرر رقم {state.current} (دون إشارة %، مثال: 85)",
+                    reply_markup=_CANCEL_KEYBOARD
                 )
                 return ASK_GPA_PERCENTAGE
         except Exception:
@@ -1833,36 +2069,30 @@ class TelegramBot:
             return ASK_GPA_ECTS
 
     async def _gpa_calc_show_result(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        from utils.analytics import GradeAnalytics
-        analytics = GradeAnalytics(self.user_storage)
-        # Build grades list in the same format as analytics expects
-        grades = []
-        for c in context.user_data['gpa_calc']['courses']:
-            grades.append({'total': str(c['percentage']), 'ects': c['ects']})
-        gpa = analytics._calculate_gpa(grades)
+        # Percentages (0-100 ints) and ECTS (0.5-20) were validated on input,
+        # so the table lookup is the whole of GradeAnalytics._calculate_gpa here
+        courses = _gpa_state(context).courses
+        points_table = gpa_points_table()
+        total_ects = sum(c.ects for c in courses)
+        if total_ects > 0:
+            gpa = round(sum(points_table[c.percentage] * c.ects for c in courses) / total_ects, 3)
+        else:
+            gpa = None
         if gpa is not None:
             # Format to exactly 3 digits from left to right (e.g., 3.15, 2.5, 4.0)
             # Remove trailing zeros and decimal point
-            gpa_str = f"{gpa:.2f}"
-            # Remove trailing zeros (including those followed by decimal point)
-            while gpa_str.endswith('0') and '.' in gpa_str:
-                gpa_str = gpa_str[:-1]
-            # Remove trailing decimal point
-            if gpa_str.endswith('.'):
-                gpa_str = gpa_str[:-1]
-            if gpa_str == '':
-                gpa_str = '0'
+            gpa_str = f"{gpa:.2f}".rstrip('0').rstrip('.') or '0'
         else:
             gpa_str = "-"
-        await update.message.reply_text(f"✅ المعدل التراكمي (GPA) للمقررات المدخلة: {gpa_str}", reply_markup=get_main_keyboard())
+        await update.message.reply_text(f"✅ المعدل التراكمي (GPA) للمقررات المدخلة: {gpa_str}", reply_markup=self._kb_main)
         context.user_data.pop('gpa_calc', None)
         return ConversationHandler.END
 
     async def _cancel_gpa_calc(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Cancel handler for custom GPA calculator flow."""
         context.user_data.pop('gpa_calc', None)
-        is_registered = self.user_storage.is_user_registered(update.effective_user.id)
-        keyboard = get_main_keyboard() if is_registered else get_unregistered_keyboard()
+        is_registered = await self._is_registered(update.effective_user.id)
+        keyboard = self._kb_main if is_registered else self._kb_unregistered
         await update.message.reply_text(
             "❌ تم إلغاء عملية حساب المعدل. يمكنك البدء من جديد أو اختيار إجراء آخر.",
             reply_markup=keyboard
@@ -1870,9 +2100,9 @@ class TelegramBot:
         return ConversationHandler.END
 
     async def _session_management_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user = self.user_storage.get_user(update.effective_user.id)
+        user = await self._get_user(update.effective_user.id)
         if not user:
-            await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=get_unregistered_keyboard())
+            await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=self._kb_unregistered)
             return ConversationHandler.END
         session_type = "دائمة" if user.get("password_stored") else "مؤقتة"
         await update.message.reply_text(
@@ -1889,37 +2119,21 @@ class TelegramBot:
     async def _handle_session_management(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = update.message.text.strip()
         user_id = update.effective_user.id
-        user = self.user_storage.get_user(user_id)
+        user = await self._get_user(user_id)
         if not user:
-            await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=get_unregistered_keyboard())
+            await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=self._kb_unregistered)
             return ConversationHandler.END
         if text == "تحويل إلى مؤقتة":
-            self.user_storage.save_user(
-                user_id,
-                user["username"],
-                user["token"],
-                user,
-                encrypted_password="",
-                password_stored=False,
-                password_consent_given=False
-            )
-            await update.message.reply_text("✅ تم التحويل إلى جلسة مؤقتة. لن يتم تخزين كلمة المرور بعد الآن.", reply_markup=get_main_keyboard())
+            await asyncio.to_thread(self.user_storage.clear_password, user_id)
+            await update.message.reply_text("✅ تم التحويل إلى جلسة مؤقتة. لن يتم تخزين كلمة المرور بعد الآن.", reply_markup=self._kb_main)
             return ConversationHandler.END
         elif text == "تحويل إلى دائمة":
             await update.message.reply_text("يرجى إعادة إدخال كلمة المرور لتخزينها بشكل مشفر:")
             context.user_data["session_upgrade"] = True
             return ASK_PASSWORD
         elif text == "حذف كلمة المرور":
-            self.user_storage.save_user(
-                user_id,
-                user["username"],
-                user["token"],
-                user,
-                encrypted_password="",
-                password_stored=False,
-                password_consent_given=False
-            )
-            await update.message.reply_text("✅ تم حذف كلمة المرور المخزنة.", reply_markup=get_main_keyboard())
+            await asyncio.to_thread(self.user_storage.clear_password, user_id)
+            await update.message.reply_text("✅ تم حذف كلمة المرور المخزنة.", reply_markup=self._kb_main)
             return ConversationHandler.END
         elif text == "🔙 العودة":
             await self._return_to_main(update, context)
@@ -1931,47 +2145,56 @@ class TelegramBot:
     async def _older_terms_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle the 'older terms' button: show list of all terms, prompt for number, then fetch grades for selected term."""
         telegram_id = update.effective_user.id
-        user = self.user_storage.get_user(telegram_id)
+        user = await self._get_user(telegram_id)
         if not user:
-            await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=get_unregistered_keyboard())
+            await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=self._kb_unregistered)
             return
         token = user.get("session_token")
         if not token:
-            await update.message.reply_text("❗️ يجب إعادة تسجيل الدخول.", reply_markup=get_unregistered_keyboard())
+            await update.message.reply_text("❗️ يجب إعادة تسجيل الدخول.", reply_markup=self._kb_unregistered)
             return
         # Fetch all terms
         homepage_data = await self.university_api.get_homepage_data(token)
         if not homepage_data:
-            await update.message.reply_text("❌ تعذر جلب قائمة الفصول. حاول لاحقاً.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("❌ تعذر جلب قائمة الفصول. حاول لاحقاً.", reply_markup=self._kb_main)
             return
         terms = self.university_api.extract_terms_from_homepage(homepage_data)
         if not terms or len(terms) < 1:
-            await update.message.reply_text("❌ لا توجد فصول متاحة.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("❌ لا توجد فصول متاحة.", reply_markup=self._kb_main)
             return
         # Show numbered list (skip first two: current, previous)
         all_terms = terms
         context.user_data['older_terms_list'] = all_terms
-        msg = "اختر رقم الفصل الذي تريد عرض درجاته:\n\n"
-        for idx, (term_name, _) in enumerate(all_terms, 1):
-            msg += f"{idx}. {term_name}\n"
-        msg += "\nأدخل رقم الفصل المطلوب (مثال: 1):"
+        # Reused by _ask_older_term_number so the term selection needs no user lookup
+        context.user_data['older_terms_token'] = token
+        context.user_data['older_terms_username'] = user.get('username')
+        msg = "".join([
+            "اختر رقم الفصل الذي تريد عرض درجاته:\n\n",
+            *(f"{idx}. {term_name}\n" for idx, (term_name, _) in enumerate(all_terms, 1)),
+            "\nأدخل رقم الفصل المطلوب (مثال: 1):",
+        ])
         await update.message.reply_text(msg, reply_markup=remove_keyboard())
         context.user_data['last_action'] = 'older_terms'
         return ASK_OLDER_TERM_NUMBER
 
     async def _ask_older_term_number(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         telegram_id = update.effective_user.id
-        user = self.user_storage.get_user(telegram_id)
-        if not user:
-            await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=get_unregistered_keyboard())
-            return ConversationHandler.END
-        token = user.get("session_token")
+        token = context.user_data.get('older_terms_token')
+        username = context.user_data.get('older_terms_username')
         if not token:
-            await update.message.reply_text("❗️ يجب إعادة تسجيل الدخول.", reply_markup=get_unregistered_keyboard())
-            return ConversationHandler.END
+            # Conversation state was lost (e.g. restart); fall back to the stored user
+            user = await self._get_user(telegram_id)
+            if not user:
+                await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=self._kb_unregistered)
+                return ConversationHandler.END
+            token = user.get("session_token")
+            if not token:
+                await update.message.reply_text("❗️ يجب إعادة تسجيل الدخول.", reply_markup=self._kb_unregistered)
+                return ConversationHandler.END
+            username = user.get('username')
         all_terms = context.user_data.get('older_terms_list')
         if not all_terms:
-            await update.message.reply_text("❌ لا توجد فصول متاحة.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("❌ لا توجد فصول متاحة.", reply_markup=self._kb_main)
             return ConversationHandler.END
         try:
             number = int(update.message.text.strip())
@@ -1982,44 +2205,51 @@ class TelegramBot:
             await update.message.reply_text(f"❌ اختر رقم بين 1 و {len(all_terms)}.")
             return ASK_OLDER_TERM_NUMBER
         term_name, term_id = all_terms[number-1]
+        # The conversation ends here; don't keep the session token around in user_data
+        context.user_data.pop('older_terms_token', None)
+        context.user_data.pop('older_terms_username', None)
         # Fetch grades for selected term
         grades = await self.university_api.get_term_grades(token, term_id)
         if not grades:
-            await update.message.reply_text(f"❌ لا توجد درجات متاحة للفصل: {term_name}", reply_markup=get_main_keyboard())
+            await update.message.reply_text(f"❌ لا توجد درجات متاحة للفصل: {term_name}", reply_markup=self._kb_main)
             return ConversationHandler.END
         # Add term info to grades
         for grade in grades:
             grade['term_name'] = term_name
             grade['term_id'] = term_id
         # Save grades to storage
-        self.grade_storage.store_grades(user.get('username'), grades)
+        await asyncio.to_thread(self.grade_storage.store_grades, username, grades)
         # Format and send grades for the selected term
         formatted_message = await self.grade_analytics.format_old_grades_with_analysis(telegram_id, grades)
-        if len(formatted_message) > 4096:
-            for i in range(0, len(formatted_message), 4096):
-                await update.message.reply_text(formatted_message[i:i+4096], reply_markup=get_main_keyboard())
-        else:
-            await update.message.reply_text(formatted_message, reply_markup=get_main_keyboard())
+        await self._reply_long(update, formatted_message, reply_markup=self._kb_main)
         return ConversationHandler.END
 
+    async def _reply_long(self, update: Update, text: str, reply_markup=None):
+        """Reply with `text` split on line boundaries; the keyboard is attached to the last chunk only"""
+        chunks = _split_message(text)
+        # Sent one after another: concurrent sends can reach the chat out of order
+        for chunk in chunks[:-1]:
+            await update.message.reply_text(chunk)
+        await update.message.reply_text(chunks[-1], reply_markup=reply_markup)
+
     async def _download_my_info_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         telegram_id = update.effective_user.id
-        user = self.user_storage.get_user(telegram_id)
+        user = await self._get_user(telegram_id)
         if not user:
-            await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=get_unregistered_keyboard())
+            await update.message.reply_text("❗️ يجب التسجيل أولاً.", reply_markup=self._kb_unregistered)
             return
-        # Remove sensitive/session fields if needed
-        user_info = dict(user)
-        user_info.pop("session_token", None)
-        # Convert to JSON
-        json_str = json.dumps(user_info, ensure_ascii=False, indent=2)
+        # Remove sensitive/session fields and serialize straight to UTF-8 JSON bytes
+        payload = orjson.dumps(
+            {key: value for key, value in user.items() if key != "session_token"},
+            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        )
         # Inform the user about privacy
         await update.message.reply_text(
             "هذه كل البيانات التي يخزنها البوت عنك. لا أحد يطلع عليها إلا عند طلبك ذلك بشكل مباشر، ويتم جلبها فقط عند طلبك."
         )
         # Send as file
         await update.message.reply_document(
-            document=bytes(json_str, encoding="utf-8"),
+            document=payload,
             filename="my_information.json",
             caption="📥 هذه جميع المعلومات المخزنة عنك في قاعدة البيانات."
         )
@@ -2029,49 +2259,83 @@ class TelegramBot:
         Refresh grades for all users and save them to storage, but do NOT send any notifications.
         Returns the number of users whose grades were refreshed.
         """
-        users = self.user_storage.get_all_users()
+        users = await asyncio.to_thread(self.user_storage.get_all_users, use_cache=False)
         logger.info(f"🔕 Silent update: Found {len(users)} users in database")
         if not users:
             logger.warning("⚠️ No users found in database for silent update")
             return 0
         updated_count = 0
-        semaphore = asyncio.Semaphore(CONFIG.get('MAX_CONCURRENT_REQUESTS', 5))
-        tasks = []
-        results = []
+        # Users are pulled from a queue by a fixed pool of workers; fetched
+        # grades are written in batches off the event loop.
+        queue = asyncio.Queue()
+        for user in users:
+            queue.put_nowait(user)
+        pending = {}
 
         async def refresh_user(user):
-            async with semaphore:
-                try:
-                    telegram_id = user.get("telegram_id")
-                    username = user.get("username")
-                    username_unique = user.get("username_unique")
-                    # Fallback: use username if username_unique is missing
-                    storage_username = username_unique or username
-                    if not storage_username:
-                        logger.error(f"[ALERT] Cannot store grades: missing username and username_unique for user with telegram_id={telegram_id}")
-                        return False
-                    token = user.get("session_token")
-                    lock = self._get_user_lock(storage_username)
-                    async with lock:
-                        if not token:
-                            return False
-                        # Test token validity
-                        if not await self.university_api.test_token(token):
-                            return False
+            try:
+                telegram_id = user.get("telegram_id")
+                username = user.get("username")
+                username_unique = user.get("username_unique")
+                # Fallback: use username if username_unique is missing
+                storage_username = username_unique or username
+                if not storage_username:
+                    logger.error(f"[ALERT] Cannot store grades: missing username and username_unique for user with telegram_id={telegram_id}")
+                    return None
+                token = user.get("session_token")
+                lock = self._get_user_lock(storage_username)
+                async with lock:
+                    if not token:
+                        return None
+                    # get_user_data validates the token itself, so no separate test_token call
+                    try:
                         user_data = await self.university_api.get_user_data(token)
-                        if not user_data or "grades" not in user_data:
-                            return False
-                        new_grades = user_data.get("grades", [])
-                        self.grade_storage.store_grades(storage_username, new_grades)
-                        return True
-                except Exception as e:
-                    logger.error(f"❌ Error in silent grade refresh for user {user.get('username', 'Unknown')}: {e}", exc_info=True)
-                    return False
+                    except InvalidTokenError:
+                        return None
+                    if not user_data or "grades" not in user_data:
+                        return None
+                    return storage_username, user_data.get("grades", [])
+            except Exception as e:
+                # Usually a transient network error; the traceback is only worth formatting when debugging
+                logger.warning(
+                    f"❌ Error in silent grade refresh for user {user.get('username', 'Unknown')}: {e}",
+                    exc_info=logger.isEnabledFor(logging.DEBUG),
+                )
+                return None
 
-        for user in users:
-            tasks.append(asyncio.create_task(refresh_user(user)))
-        if tasks:
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            updated_count = sum(1 for r in results if r is True)
+        async def flush():
+            nonlocal updated_count
+            if not pending:
+                return
+            batch = dict(pending)
+            pending.clear()
+            if await asyncio.to_thread(self.grade_storage.store_grades_bulk, batch):
+                updated_count += len(batch)
+
+        async def worker():
+            while True:
+                try:
+                    user = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                # Same per-user bound as the notifying sweep, so one stalled fetch can't hold a worker
+                try:
+                    async with self._grade_check_slots, asyncio.timeout(GRADE_CHECK_USER_TIMEOUT_SECONDS):
+                        result = await refresh_user(user)
+                except TimeoutError:
+                    logger.warning(f"⏱️ Silent grade refresh timed out for user {user.get('username', 'Unknown')}")
+                    continue
+                if result:
+                    storage_username, grades = result
+                    pending[storage_username] = grades
+                    if len(pending) >= SILENT_UPDATE_BATCH_SIZE:
+                        await flush()
+
+        worker_count = min(CONFIG.get('MAX_CONCURRENT_REQUESTS', 5), len(users))
+        # refresh_user swallows per-user errors, so the group only aborts on a storage failure
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(worker_count):
+                tg.create_task(worker())
+        await flush()
         logger.info(f"🔕 Silent update completed: {updated_count}/{len(users)} users refreshed")
         return updated_count
\ No newline at end of file
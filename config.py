@@ -38,6 +38,8 @@ if database_url_env and database_url_env.startswith("mysql://"):
 CONFIG = {
     # Telegram bot token
     "TELEGRAM_TOKEN": os.getenv("TELEGRAM_TOKEN", "your_bot_token_here"),
+    # Secret Telegram echoes in X-Telegram-Bot-Api-Secret-Token (random per start if unset)
+    "WEBHOOK_SECRET": os.getenv("WEBHOOK_SECRET"),
     # Admin configuration
     "ADMIN_ID": int(os.getenv("ADMIN_ID", "123456789")),  # Telegram ID for admin
     "ADMIN_USERNAME": os.getenv("ADMIN_USERNAME", "@admin_username"),
@@ -47,6 +49,9 @@ CONFIG = {
     "MYSQL_URL": database_url_env,
     "USE_POSTGRESQL": bool((database_url_env or "").startswith("postgresql")),
     "USE_MYSQL": bool((database_url_env or "").startswith("mysql")),
+    # One SQLAlchemy pool is shared by user and grade storage
+    "DB_POOL_SIZE": int(os.getenv("DB_POOL_SIZE", "10")),
+    "DB_MAX_OVERFLOW": int(os.getenv("DB_MAX_OVERFLOW", "20")),
     # University API configuration
     "UNIVERSITY_LOGIN_URL": "https://api.staging.sis.shamuniversity.com/portal",  # /portal for login
     "UNIVERSITY_API_URL": "https://api.staging.sis.shamuniversity.com/graphql",  # /graphql for API